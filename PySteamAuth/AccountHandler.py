@@ -16,12 +16,16 @@
 
 import requests
 import urllib.parse
-from steam import webauth
-from PyQt5 import QtWidgets, QtGui
+from steam import webauth, guard
+from steam.steamid import SteamID
+from PyQt5 import QtGui
 import json
 
 import PyUIs
 import Common
+import DialogHandler
+import Metrics
+import RequestHandler
 
 
 class Empty:
@@ -29,19 +33,93 @@ class Empty:
 # TODO move file handling here
 
 
-def refresh_session(sa):  # TODO only run this when steammobile://lostauth
+# Called with the SteamAuthenticator and the top-level keys of its secrets that changed, whenever they should be
+# written back to its maFile
+save_secrets = None
+
+
+def save_web_session(sa, keys=('WebSession',)):
+    mwa = sa.backend
+    if not (isinstance(mwa, webauth.MobileWebAuth) and mwa.logged_on):
+        return
+    sa.secrets['WebSession'] = {
+        'username': mwa.username,
+        'steam_id': int(mwa.steam_id),
+        'oauth_token': mwa.oauth_token,
+        'session_id': mwa.session_id,
+        'cookies': [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'secure': c.secure}
+                    for c in mwa.session.cookies]
+    }
+    if save_secrets:
+        save_secrets(sa, keys)
+
+
+def restore_web_session(sa):
+    # Rebuilds a logged on MobileWebAuth from the persisted session without contacting Steam. The session is only
+    # checked when it is used; see call_with_backend.
+    data = sa.secrets.get('WebSession')
+    if not data:
+        return None
+    try:
+        mwa = webauth.MobileWebAuth(username=data['username'])
+        mwa.steam_id = SteamID(data['steam_id'])
+        mwa.oauth_token = data['oauth_token']
+        mwa.session_id = data['session_id']
+        for c in data['cookies']:
+            mwa.session.cookies.set(c['name'], c['value'], domain=c['domain'], path=c['path'], secure=c['secure'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    mwa.logged_on = True
+    mwa.restored = True
+    return mwa
+
+
+def invalidate_web_session(sa):
+    sa.backend = None
+    if sa.secrets.pop('WebSession', None) is not None and save_secrets:
+        save_secrets(sa, ['WebSession'])
+
+
+def session_rejected(error):
+    return any(i in str(error) for i in ['401', '403', 'not logged in'])
+
+
+def call_with_backend(sa, func, *args):
+    # Runs func with sa.backend logged on. If Steam rejects a restored session, the persisted session is dropped and
+    # the call is retried once after an interactive login.
+    try:
+        return func(*args)
+    except guard.SteamAuthenticatorError as e:
+        if not (getattr(sa.backend, 'restored', False) and session_rejected(e)):
+            raise
+        invalidate_web_session(sa)
+        if not get_mobilewebauth(sa):
+            raise
+        return func(*args)
+
+
+class SessionExpired(Exception):
+    pass
+
+
+def refresh_session(sa, interactive=True):  # TODO only run this when steammobile://lostauth
+    # Background callers pass interactive=False: an expired session then raises SessionExpired instead of opening the
+    # login dialog
     url = 'https://api.steampowered.com/IMobileAuthService/GetWGToken/v0001'
     try:
-        r = requests.post(url, data={'access_token': urllib.parse.quote_plus(sa.secrets['Session']['OAuthToken'])})
-        response = json.loads(r.text)['response']
-        sa.secrets['Session']['SteamLogin'] = str(sa.secrets['Session']['SteamID']) + "%7C%7C" + response['token']
-        sa.secrets['Session']['SteamLoginSecure'] = str(sa.secrets['Session']['SteamID']) + "%7C%7C" +\
-            response['token_secure']
+        r = RequestHandler.request('GetWGToken', 'POST', url, account=Metrics.account_label(sa),
+                                   data={'access_token': urllib.parse.quote_plus(sa.secrets['Session']['OAuthToken'])})
+        apply_wg_token(sa, r.text)
+        Metrics.session_refreshes.inc(account=Metrics.account_label(sa), outcome='success')
         return True
-    except requests.exceptions.ConnectionError:
-        Common.error_popup('Failed to refresh session (connection error).', 'Warning')
+    except requests.exceptions.RequestException:
+        Metrics.session_refreshes.inc(account=Metrics.account_label(sa), outcome='connection_error')
+        Common.notify('Failed to refresh session (connection error).', 'Warning')
         return False
     except (json.JSONDecodeError, KeyError):
+        Metrics.session_refreshes.inc(account=Metrics.account_label(sa), outcome='expired')
+        if not interactive:
+            raise SessionExpired()
         Common.error_popup('Steam session expired. You will be prompted to sign back in.')
         if full_refresh(sa):
             return refresh_session(sa)
@@ -49,26 +127,46 @@ def refresh_session(sa):  # TODO only run this when steammobile://lostauth
             return False
 
 
+def apply_wg_token(sa, page):
+    # Shared by the sync and asyncio APIs; raises json.JSONDecodeError or KeyError when Steam did not issue a token
+    response = json.loads(page)['response']
+    sa.secrets['Session']['SteamLogin'] = str(sa.secrets['Session']['SteamID']) + "%7C%7C" + response['token']
+    sa.secrets['Session']['SteamLoginSecure'] = str(sa.secrets['Session']['SteamID']) + "%7C%7C" +\
+        response['token_secure']
+
+
 def full_refresh(sa):
+    invalidate_web_session(sa)
     mwa = get_mobilewebauth(sa, True)
     if not mwa:
         return False
+    store_session(sa, mwa)
+    return True
+
+
+def store_session(sa, mwa):
+    # Makes a fresh login the account's backend and mobile session; save_web_session writes both to the maFile
     if 'Session' not in sa.secrets:
         sa.secrets['Session'] = {'SteamID': mwa.steam_id}
     sa.secrets['Session']['OAuthToken'] = mwa.oauth_token
     sa.secrets['Session']['SessionID'] = mwa.session_id
-    return True
+    sa.backend = mwa
+    save_web_session(sa, ['Session', 'WebSession'])
 
 
 def get_mobilewebauth(sa=None, force_login=True):
     if sa and isinstance(sa.backend, webauth.MobileWebAuth) and sa.backend.logged_on:
         return sa.backend
+    if sa:
+        restored = restore_web_session(sa)
+        if restored:
+            sa.backend = restored
+            return restored
     endfunc = Empty()
     endfunc.endfunc = False
-    login_dialog = QtWidgets.QDialog()
-    login_ui = PyUIs.LogInDialog.Ui_Dialog()
-    login_ui.setupUi(login_dialog)
-    login_ui.buttonBox.rejected.connect(lambda: setattr(endfunc, 'endfunc', True))
+    login_dialog = DialogHandler.get_dialog(PyUIs.LogInDialog.Ui_Dialog)
+    login_ui = login_dialog.ui
+    login_dialog.bind(login_ui.buttonBox.rejected, lambda: setattr(endfunc, 'endfunc', True))
     login_ui.usernameBox.setDisabled((force_login and (sa is not None)))
     if sa:
         login_ui.usernameBox.setText(sa.secrets['account_name'])
@@ -81,7 +179,9 @@ def get_mobilewebauth(sa=None, force_login=True):
         user = webauth.MobileWebAuth(username=login_ui.usernameBox.text(), password=login_ui.passwordBox.text())
         username = login_ui.usernameBox.text()
         try:
-            user.login()
+            Common.run_in_background(user.login, text='Logging in...')
+        except Common.Cancelled:
+            return
         except webauth.HTTPError:
             Common.error_popup('Connection Error')
             return
@@ -106,12 +206,15 @@ def get_mobilewebauth(sa=None, force_login=True):
     email_code = ''
     while True:
         if required == 'captcha':
-            captcha_dialog = QtWidgets.QDialog()
-            captcha_ui = PyUIs.CaptchaDialog.Ui_Dialog()
-            captcha_ui.setupUi(captcha_dialog)
-            captcha_ui.buttonBox.rejected.connect(lambda: setattr(endfunc, 'endfunc', True))
+            captcha_dialog = DialogHandler.get_dialog(PyUIs.CaptchaDialog.Ui_Dialog)
+            captcha_ui = captcha_dialog.ui
+            captcha_dialog.bind(captcha_ui.buttonBox.rejected, lambda: setattr(endfunc, 'endfunc', True))
             pixmap = QtGui.QPixmap()
-            pixmap.loadFromData(requests.get(user.captcha_url).text)
+            try:
+                pixmap.loadFromData(Common.run_in_background(
+                    lambda: RequestHandler.request('captcha', 'GET', user.captcha_url).content))
+            except Common.Cancelled:
+                return
             captcha_ui.captchaLabel.setPixmap(pixmap)
             while True:
                 captcha_dialog.exec_()
@@ -119,8 +222,11 @@ def get_mobilewebauth(sa=None, force_login=True):
                     return
                 captcha = captcha_ui.captchaInputBox.text()
                 try:
-                    user.login(captcha=captcha, email_code=email_code, twofactor_code=twofactor_code)
+                    Common.run_in_background(user.login, captcha=captcha, email_code=email_code,
+                                             twofactor_code=twofactor_code, text='Logging in...')
                     break
+                except Common.Cancelled:
+                    return
                 except webauth.CaptchaRequired:
                     captcha_ui.label_3.setText('Incorrect')
                 except webauth.LoginIncorrect as e:
@@ -132,10 +238,9 @@ def get_mobilewebauth(sa=None, force_login=True):
                     required = '2FA'
                     break
         elif required == 'email':
-            code_dialog = QtWidgets.QDialog()
-            code_ui = PyUIs.PhoneDialog.Ui_Dialog()
-            code_ui.setupUi(code_dialog)
-            code_ui.buttonBox.rejected.connect(lambda: setattr(endfunc, 'endfunc', True))
+            code_dialog = DialogHandler.get_dialog(PyUIs.PhoneDialog.Ui_Dialog)
+            code_ui = code_dialog.ui
+            code_dialog.bind(code_ui.buttonBox.rejected, lambda: setattr(endfunc, 'endfunc', True))
             code_dialog.setWindowTitle('Email code')
             code_ui.actionBox.setText('Enter the email code you have received:')
             while True:
@@ -144,8 +249,11 @@ def get_mobilewebauth(sa=None, force_login=True):
                     return
                 email_code = code_ui.codeBox.text()
                 try:
-                    user.login(email_code=email_code, captcha=captcha)
+                    Common.run_in_background(user.login, email_code=email_code, captcha=captcha,
+                                             text='Logging in...')
                     break
+                except Common.Cancelled:
+                    return
                 except webauth.EmailCodeRequired:
                     code_ui.msgBox.setText('Invalid code')
                 except webauth.LoginIncorrect as e:
@@ -154,10 +262,9 @@ def get_mobilewebauth(sa=None, force_login=True):
                     required = 'captcha'
                     break
         elif required == '2FA':
-            code_dialog = QtWidgets.QDialog()
-            code_ui = PyUIs.PhoneDialog.Ui_Dialog()
-            code_ui.setupUi(code_dialog)
-            code_ui.buttonBox.rejected.connect(lambda: setattr(endfunc, 'endfunc', True))
+            code_dialog = DialogHandler.get_dialog(PyUIs.PhoneDialog.Ui_Dialog)
+            code_ui = code_dialog.ui
+            code_dialog.bind(code_ui.buttonBox.rejected, lambda: setattr(endfunc, 'endfunc', True))
             code_dialog.setWindowTitle('2FA code')
             code_ui.actionBox.setText('Enter a two-factor code for Steam:')
             while True:
@@ -169,8 +276,11 @@ def get_mobilewebauth(sa=None, force_login=True):
                         return
                     twofactor_code = code_ui.codeBox.text()
                 try:
-                    user.login(twofactor_code=twofactor_code, captcha=captcha)
+                    Common.run_in_background(user.login, twofactor_code=twofactor_code, captcha=captcha,
+                                             text='Logging in...')
                     break
+                except Common.Cancelled:
+                    return
                 except webauth.TwoFactorCodeRequired:
                     code_ui.msgBox.setText('Invalid Code')
                 except webauth.LoginIncorrect as e:
@@ -182,4 +292,5 @@ def get_mobilewebauth(sa=None, force_login=True):
             break
     if sa:
         sa.backend = user
+        save_web_session(sa)
     return user
@@ -0,0 +1,134 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import base64
+import collections
+import os
+import threading
+import weakref
+
+import FileHandler
+
+
+class AccountHandle(object):
+    # What is kept for every account in the manifest: the name and the decoded shared secret, enough to list the
+    # account and show its codes. Everything else is read from the maFile when the authenticator is needed.
+    __slots__ = ('filename', 'account_name', 'shared_secret')
+
+    def __init__(self, filename, account_name, shared_secret):
+        self.filename = filename
+        self.account_name = account_name
+        self.shared_secret = shared_secret
+
+    @classmethod
+    def from_secrets(cls, filename, secrets):
+        return cls(filename, secrets['account_name'], base64.b64decode(secrets['shared_secret']))
+
+
+# Handles for every account, plus at most capacity live authenticators. The least recently used one is evicted
+# first, and takes its web session and cookie jar with it. A session saved with AccountHandler.save_web_session is
+# restored from the maFile the next time the account is loaded. Pinned accounts (the one on screen) are never evicted.
+class AccountStore(object):
+    def __init__(self, folder=None, capacity=256):
+        self.folder = folder
+        self.capacity = capacity
+        self.handles = {}
+        self.live = collections.OrderedDict()
+        self.pinned = set()
+        # The file of every authenticator handed out, for as long as anything still holds it
+        self.owners = weakref.WeakKeyDictionary()
+        self.lock = threading.RLock()
+
+    def configure(self, folder, config=None):
+        # From the manifest, eg. "account_cache": {"capacity": 256}
+        with self.lock:
+            if folder != self.folder:
+                self.handles.clear()
+                self.live.clear()
+                self.pinned.clear()
+            self.folder = folder
+            self.capacity = max(1, (config or {}).get('capacity', 256))
+            self.evict()
+
+    def handle(self, filename):
+        # Reads the maFile the first time; raises IOError or ValueError (or KeyError) for a broken one
+        with self.lock:
+            if filename in self.handles:
+                return self.handles[filename]
+        with FileHandler.locked(self.folder, False):
+            secrets = FileHandler.read_json(os.path.join(self.folder, filename))
+        handle = AccountHandle.from_secrets(filename, secrets)
+        with self.lock:
+            return self.handles.setdefault(filename, handle)
+
+    def get(self, filename):
+        # The live authenticator, without loading one
+        with self.lock:
+            return self.live.get(filename)
+
+    def load(self, filename, factory):
+        # Returns the live authenticator, or makes one with factory() and possibly evicts another
+        with self.lock:
+            if filename in self.live:
+                self.live.move_to_end(filename)
+                return self.live[filename]
+        sa = factory()
+        with self.lock:
+            if filename in self.live:
+                self.live.move_to_end(filename)
+                return self.live[filename]
+            self.handles[filename] = AccountHandle.from_secrets(filename, sa.secrets)
+            self.live[filename] = sa
+            self.owners[sa] = filename
+            self.evict()
+        return sa
+
+    def evict(self):
+        with self.lock:
+            for filename in [i for i in self.live if i not in self.pinned][:max(len(self.live) - self.capacity, 0)]:
+                del self.live[filename]
+
+    def pin(self, *filenames):
+        with self.lock:
+            self.pinned = set(filenames)
+            self.evict()
+
+    def update(self, filename, secrets):
+        # Takes the secrets of a maFile that changed on disk; returns the live authenticator, if any
+        with self.lock:
+            self.handles[filename] = AccountHandle.from_secrets(filename, secrets)
+            sa = self.live.get(filename)
+            if sa is not None:
+                sa.secrets = secrets
+            return sa
+
+    def discard(self, filename):
+        with self.lock:
+            self.handles.pop(filename, None)
+            self.live.pop(filename, None)
+
+    def retain(self, filenames):
+        filenames = set(filenames)
+        with self.lock:
+            for i in [i for i in self.handles if i not in filenames]:
+                del self.handles[i]
+            for i in [i for i in self.live if i not in filenames]:
+                del self.live[i]
+
+    def filename_of(self, sa):
+        # Also works for authenticators that were evicted since; raises KeyError for one the store never loaded
+        with self.lock:
+            return self.owners[sa]
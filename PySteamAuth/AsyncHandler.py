@@ -0,0 +1,228 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import json
+import time
+import urllib.parse
+
+import AccountHandler
+import AuditLog
+import ChangeFeed
+import ConfirmationHandler
+import Metrics
+import RequestHandler
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+# Seconds before a failed QueryTime is tried again
+TIME_SYNC_RETRY = 60
+
+
+# asyncio versions of fetch_confirmations, confirm, confirm_multi and refresh_session for services that drive many
+# accounts from one event loop. Requests follow the same per-endpoint policies, circuit breakers and metrics as
+# RequestHandler, parsing is shared with the sync API, and nothing here opens a dialog: failures are returned (or
+# raised) to the caller instead.
+class AsyncClient(object):
+    def __init__(self, limit=100, limit_per_host=0):
+        if aiohttp is None:
+            raise ImportError('The asyncio API requires aiohttp')
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.session = None
+        self.time_offset = None
+        self.time_sync_failed = None
+        # Optional coroutine function awaited with the endpoint before every attempt, for rate limits shared with
+        # other processes (see ShardHandler)
+        self.admission = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open(self):
+        # One connection pool for every account. Cookies are sent per request, so the session keeps no jar of its own.
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host),
+                cookie_jar=aiohttp.DummyCookieJar())
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, endpoint, method, url, idempotent=True, account='', params=None, **kwargs):
+        # Same retry, breaker and metrics handling as RequestHandler.request. Returns (status, text); raises
+        # aiohttp.ClientError, asyncio.TimeoutError or RequestHandler.CircuitOpenError.
+        await self.open()
+        policy = RequestHandler.get_policy(endpoint)
+        breaker = RequestHandler.get_breaker(endpoint, policy)
+        attempts = (policy['retries'] + 1) if idempotent else 1
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(sock_connect=policy['connect_timeout'],
+                                                           sock_read=policy['read_timeout']))
+        if params is not None:
+            # Sent exactly like the sync API's pre-joined query strings
+            url = yarl.URL(url + '?' + '&'.join('%s=%s' % (k, v) for k, v in params.items()), encoded=True)
+        start = time.monotonic()
+        outcome = 'error'
+        try:
+            for attempt in range(attempts):
+                if attempt:
+                    Metrics.steam_request_retries.inc(endpoint=endpoint)
+                if not breaker.allow():
+                    outcome = 'circuit_open'
+                    raise RequestHandler.CircuitOpenError('{0} is unavailable; not retrying for now'.format(endpoint))
+                if self.admission:
+                    await self.admission(endpoint)
+                with breaker.attempt() as result:
+                    try:
+                        async with self.session.request(method, url, **kwargs) as r:
+                            status, text = r.status, await r.text()
+                        if status < 500:
+                            result.success()
+                            outcome = 'success' if status < 400 else 'http_' + str(status)
+                            return status, text
+                        result.failure()
+                        if attempt + 1 == attempts:
+                            outcome = 'http_' + str(status)
+                            raise aiohttp.ClientResponseError(None, (), status=status)
+                    except asyncio.TimeoutError:
+                        result.failure()
+                        if attempt + 1 == attempts:
+                            outcome = 'timeout'
+                            raise
+                    except aiohttp.ClientConnectionError:
+                        result.failure()
+                        if attempt + 1 == attempts:
+                            outcome = 'connection_error'
+                            raise
+                await asyncio.sleep(RequestHandler.backoff_delay(policy, attempt))
+        finally:
+            Metrics.steam_requests.inc(endpoint=endpoint, account=account, outcome=outcome)
+            Metrics.steam_request_seconds.observe(time.monotonic() - start, endpoint=endpoint, account=account,
+                                                  outcome=outcome)
+
+    async def sync_time(self, accounts=()):
+        # SteamAuthenticator.get_time would otherwise do a blocking time sync per account on first use. A failed sync
+        # is not remembered: the local clock is used and the sync is tried again after TIME_SYNC_RETRY seconds.
+        offset = self.time_offset
+        if offset is None and (self.time_sync_failed is None or
+                               time.monotonic() - self.time_sync_failed >= TIME_SYNC_RETRY):
+            try:
+                status, text = await self.request('QueryTime', 'POST',
+                                                  'https://api.steampowered.com/ITwoFactorService/QueryTime/v1/')
+                offset = self.time_offset = int(json.loads(text)['response']['server_time']) - int(time.time())
+            except (aiohttp.ClientError, asyncio.TimeoutError, RequestHandler.CircuitOpenError, ValueError, KeyError):
+                self.time_sync_failed = time.monotonic()
+        for sa in accounts:
+            sa.steam_time_offset = offset or 0
+            sa._offset_last_check = time.time()
+        return offset or 0
+
+    async def fetch_confirmations(self, sa):
+        # Unlike the sync call, errors are raised so that they can be told apart from an empty list: connection errors,
+        # non-200 responses and pages that are neither a list nor "Nothing to confirm" (eg. a login page)
+        await self.sync_time([sa])
+        url = 'https://steamcommunity.com/mobileconf/conf'
+        status, text = await self.request('mobileconf/conf', 'GET', url, account=Metrics.account_label(sa),
+                                          params=ConfirmationHandler.generate_query('conf', sa),
+                                          headers={'Cookie': cookie_header(sa)})
+        if status != 200:
+            raise aiohttp.ClientResponseError(None, (), status=status)
+        ret = ConfirmationHandler.parse_confirmations(text)
+        if not len(ret) and '<div>Nothing to confirm</div>' not in text:
+            raise aiohttp.ClientResponseError(None, (), status=status, message='Not a confirmation list')
+        Metrics.confirmations.inc(len(ret), account=Metrics.account_label(sa), action='fetched')
+        ChangeFeed.observe(Metrics.account_label(sa), ret, text)
+        ConfirmationHandler.pending_probe(sa).fetched(ret, text)
+        return ret
+
+    async def needs_fetch(self, sa):
+        # Same probe as ConfirmationHandler.needs_fetch; a failed probe just means fetching the full list
+        if not ConfirmationHandler.probe_max_skip:
+            return True
+        try:
+            status, text = await self.request('actions/GetNotificationCounts', 'GET',
+                                              'https://steamcommunity.com/actions/GetNotificationCounts',
+                                              account=Metrics.account_label(sa), headers={'Cookie': cookie_header(sa)})
+            signature = ConfirmationHandler.notification_signature(text) if status == 200 else None
+        except (aiohttp.ClientError, asyncio.TimeoutError, RequestHandler.CircuitOpenError):
+            signature = None
+        return ConfirmationHandler.pending_probe(sa).check(Metrics.account_label(sa), signature)
+
+    async def confirm(self, sa, conf, action):
+        # Returns True when Steam accepted the action, False otherwise; recorded in the audit log like the sync call
+        await self.sync_time([sa])
+        params = ConfirmationHandler.generate_query(action, sa)
+        params.update({'cid': conf.id, 'ck': conf.key})
+        return await self.submit(sa, [conf], action, 'mobileconf/ajaxop', 'GET',
+                                 'https://steamcommunity.com/mobileconf/ajaxop', params=params)
+
+    async def confirm_multi(self, sa, confs, action):
+        await self.sync_time([sa])
+        data = ConfirmationHandler.generate_query(action, sa)
+        form = [(k, v) for k, v in data.items()] + [('cid[]', i.id) for i in confs] + [('ck[]', i.key) for i in confs]
+        return await self.submit(sa, list(confs), action, 'mobileconf/multiajaxop', 'POST',
+                                 'https://steamcommunity.com/mobileconf/multiajaxop', data=form)
+
+    async def submit(self, sa, confs, action, endpoint, method, url, **kwargs):
+        action_name = ConfirmationHandler.ACTION_NAMES.get(action, action)
+        pre_time = time.time()
+        try:
+            status, text = await self.request(endpoint, method, url, idempotent=False,
+                                              account=Metrics.account_label(sa), headers={'Cookie': cookie_header(sa)},
+                                              **kwargs)
+            success = json.loads(text)['success']
+            outcome = 'success' if success else 'rejected'
+        except (aiohttp.ClientError, asyncio.TimeoutError, RequestHandler.CircuitOpenError, ValueError, KeyError):
+            success = False
+            outcome = 'error'
+        for conf in confs:
+            AuditLog.record(Metrics.account_label(sa), conf, action_name, outcome, time.time() - pre_time)
+            ChangeFeed.acted(Metrics.account_label(sa), conf, action_name, outcome)
+        if success:
+            Metrics.confirmations.inc(len(confs), account=Metrics.account_label(sa), action=action_name)
+        return bool(success)
+
+    async def refresh_session(self, sa):
+        # Returns True on success. An expired session returns False; logging back in is up to the caller
+        # (eg. LoginHandler.login in an executor).
+        url = 'https://api.steampowered.com/IMobileAuthService/GetWGToken/v0001'
+        try:
+            status, text = await self.request(
+                'GetWGToken', 'POST', url, account=Metrics.account_label(sa),
+                data={'access_token': urllib.parse.quote_plus(sa.secrets['Session']['OAuthToken'])})
+            AccountHandler.apply_wg_token(sa, text)
+        except (aiohttp.ClientError, asyncio.TimeoutError, RequestHandler.CircuitOpenError):
+            Metrics.session_refreshes.inc(account=Metrics.account_label(sa), outcome='connection_error')
+            return False
+        except (ValueError, KeyError):
+            Metrics.session_refreshes.inc(account=Metrics.account_label(sa), outcome='expired')
+            return False
+        Metrics.session_refreshes.inc(account=Metrics.account_label(sa), outcome='success')
+        return True
+
+
+def cookie_header(sa):
+    return '; '.join('{0}={1}'.format(c.name, c.value) for c in ConfirmationHandler.generate_cookiejar(sa))
@@ -0,0 +1,247 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import atexit
+import bisect
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+
+import FileHandler
+
+
+# Confirmation actions are appended as JSON lines to numbered segments (actions-000001.log, ...) that are never
+# rewritten. Records are buffered and written in batches grouped by account; every batch adds one line per account to
+# the segment's sidecar .idx file with the account, time range and byte range of its records. A segment is sealed once
+# it reaches max_bytes or its index reaches max_index_bytes, and a .sum file with its time range and accounts is
+# written next to it. Queries binary-search the sealed segments by time, skip those whose summary can't match, and
+# read the index and byte ranges of the rest; only the live segment's index, which max_index_bytes bounds, is always
+# read.
+class AuditLog(object):
+    def __init__(self, folder, max_bytes=64 * 1024 * 1024, buffer_size=256, flush_interval=2,
+                 max_index_bytes=1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_index_bytes = max_index_bytes
+        self.buffer = []
+        # Summaries of sealed segments, which never change
+        self.summaries = {}
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        with FileHandler.locked(self.folder):
+            self.recover()
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.folder, 'actions-*.log')))
+
+    def record(self, **fields):
+        fields['ts'] = round(time.time(), 3)
+        with self.lock:
+            self.buffer.append(fields)
+            full = len(self.buffer) >= self.buffer_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            records, self.buffer = self.buffer, []
+        if not records:
+            return
+        # Other processes sharing the maFiles folder append to the same log
+        with FileHandler.locked(self.folder):
+            segments = self.segments()
+            path = segments[-1] if segments else self.segment_path(1)
+            if os.path.isfile(path) and (os.path.getsize(path) >= self.max_bytes or
+                                         file_size(path[:-4] + '.idx') >= self.max_index_bytes):
+                FileHandler.write_json(path[:-4] + '.sum', summarize(read_index(path[:-4] + '.idx')))
+                path = self.segment_path(int(os.path.basename(path)[8:-4]) + 1)
+            self.append(path, records)
+
+    def append(self, path, records):
+        by_account = {}
+        for i in records:
+            by_account.setdefault(i.get('account', ''), []).append(i)
+        index = []
+        with open(path, 'ab') as f:
+            offset = f.tell()
+            for account, account_records in sorted(by_account.items()):
+                data = b''.join(json.dumps(i, sort_keys=True).encode('utf-8') + b'\n' for i in account_records)
+                f.write(data)
+                index.append({'account': account, 'start': min(i['ts'] for i in account_records),
+                              'end': max(i['ts'] for i in account_records), 'offset': offset, 'length': len(data),
+                              'count': len(account_records)})
+                offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        # The index is written after the data it points to; recover() indexes anything a crash left in between
+        with open(path[:-4] + '.idx', 'a') as f:
+            f.write(''.join(json.dumps(i, sort_keys=True) + '\n' for i in index))
+
+    def segment_path(self, number):
+        return os.path.join(self.folder, 'actions-{0:06d}.log'.format(number))
+
+    def recover(self):
+        segments = self.segments()
+        if not segments:
+            return
+        path = segments[-1]
+        offset = max([i['offset'] + i['length'] for i in read_index(path[:-4] + '.idx')] or [0])
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            tail = f.read()
+        # Records a crash left unindexed are indexed in place; a torn last line is cut off
+        complete = tail[:tail.rfind(b'\n') + 1]
+        if len(complete) != len(tail):
+            with open(path, 'r+b') as f:
+                f.truncate(offset + len(complete))
+        index = []
+        bad = []
+        good_end = offset
+        for line in complete.splitlines(True):
+            try:
+                record = json.loads(line.decode('utf-8'))
+                record['ts'] = float(record['ts'])
+            except (ValueError, KeyError, TypeError):
+                # Copied aside and left out of the index, so queries never read it; the next line starts a new block
+                bad.append(line)
+                offset += len(line)
+                index.append(None)
+                continue
+            if index and index[-1] and index[-1]['account'] == record.get('account', ''):
+                block = index[-1]
+                block['start'] = min(block['start'], record['ts'])
+                block['end'] = max(block['end'], record['ts'])
+                block['length'] += len(line)
+                block['count'] += 1
+            else:
+                index.append({'account': record.get('account', ''), 'start': record['ts'], 'end': record['ts'],
+                              'offset': offset, 'length': len(line), 'count': 1})
+            offset += len(line)
+            good_end = offset
+        index = [i for i in index if i]
+        if bad:
+            with open(path[:-4] + '.corrupt', 'ab') as f:
+                f.write(b''.join(bad))
+            # Bad lines past the last good one are cut off, or the next start would find them again
+            if good_end != offset:
+                with open(path, 'r+b') as f:
+                    f.truncate(good_end)
+        if index:
+            with open(path[:-4] + '.idx', 'a') as f:
+                f.write(''.join(json.dumps(i, sort_keys=True) + '\n' for i in index))
+
+    def summary(self, path):
+        # A segment sealed before a crash could write its summary is summarized from its index instead
+        if path not in self.summaries:
+            try:
+                summary = FileHandler.read_json(path[:-4] + '.sum')
+            except (IOError, ValueError):
+                summary = summarize(read_index(path[:-4] + '.idx'))
+            summary['accounts'] = set(summary['accounts'])
+            self.summaries[path] = summary
+        return self.summaries[path]
+
+    def query(self, account=None, since=None, until=None):
+        # Yields matching records oldest batch first; since/until are unix timestamps
+        self.flush()
+        segments = self.segments()
+        sealed = [self.summary(i) for i in segments[:-1]]
+        # Segments follow each other in time, but batches from several processes can overlap at the boundaries, so the
+        # search runs on the running maximum of their ends
+        ends = list(itertools.accumulate((i['end'] for i in sealed), max))
+        first = bisect.bisect_left(ends, since) if since is not None else 0
+        for n in range(first, len(segments)):
+            path = segments[n]
+            if n < len(sealed) and (not sealed[n]['count'] or
+                                    (account is not None and account not in sealed[n]['accounts']) or
+                                    (since is not None and sealed[n]['end'] < since) or
+                                    (until is not None and sealed[n]['start'] > until)):
+                continue
+            blocks = [i for i in read_index(path[:-4] + '.idx')
+                      if (account is None or i['account'] == account) and
+                      (since is None or i['end'] >= since) and (until is None or i['start'] <= until)]
+            if not blocks:
+                continue
+            with open(path, 'rb') as f:
+                for block in blocks:
+                    f.seek(block['offset'])
+                    for line in f.read(block['length']).decode('utf-8').splitlines():
+                        record = json.loads(line)
+                        if (since is None or record['ts'] >= since) and (until is None or record['ts'] <= until):
+                            yield record
+
+
+def read_index(path):
+    try:
+        with open(path) as f:
+            return [json.loads(i) for i in f if i.strip()]
+    except IOError:
+        return []
+
+
+def summarize(index):
+    return {'start': min([i['start'] for i in index] or [0]), 'end': max([i['end'] for i in index] or [0]),
+            'count': sum(i['count'] for i in index), 'accounts': sorted(set(i['account'] for i in index))}
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+log = None
+
+
+def configure(folder, config=None):
+    # On by default, written to <maFiles>/audit. From the manifest, eg. "audit_log": false, or "audit_log":
+    # {"path": "/var/log/psa-audit", "max_bytes": 67108864, "max_index_bytes": 1048576, "flush_interval": 2}
+    global log
+    if config is False or (config or {}).get('enabled') is False:
+        return None
+    config = config or {}
+    if log is None:
+        log = AuditLog(config.get('path', os.path.join(folder, 'audit')), config.get('max_bytes', 64 * 1024 * 1024),
+                       config.get('buffer_size', 256), config.get('flush_interval', 2),
+                       config.get('max_index_bytes', 1024 * 1024))
+
+        def loop():
+            while True:
+                time.sleep(log.flush_interval)
+                try:
+                    log.flush()
+                except OSError:
+                    pass
+        threading.Thread(target=loop, name='AuditLogFlusher', daemon=True).start()
+        atexit.register(log.flush)
+    return log
+
+
+def record(sa_label, conf, action, outcome, latency):
+    if log is None:
+        return
+    log.record(account=sa_label, id=conf.id, type=conf.type, creator=conf.creator, description=conf.description,
+               action=action, outcome=outcome, latency=round(latency, 3))
+
+
+def query(account=None, since=None, until=None):
+    return log.query(account, since, until) if log else iter(())
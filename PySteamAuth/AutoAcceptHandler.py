@@ -0,0 +1,132 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from PyQt5 import QtCore
+
+import ConfirmationHandler
+import AccountHandler
+import Common
+import Metrics
+import Profiler
+
+
+class AutoAcceptJob(object):
+    # Owns the auto-accept timer. The timeout signal is connected exactly once; checkbox changes only update the
+    # settings. Ticks that arrive while a run is still in progress (on the worker thread, or Accept All behind a
+    # dialog) are coalesced into a single follow-up run, and confirmation ids are tracked so that each is submitted at
+    # most once.
+    def __init__(self, timer, sa=None):
+        self.timer = timer
+        self.sa = sa
+        self.trades = False
+        self.markets = False
+        # Optional predicate on confirmations with their details loaded, from the manifest's auto_accept_rules; see
+        # ConfirmationHandler.details_rule
+        self.details_filter = None
+        self.running = False
+        self.pending = False
+        self.worker = None
+        self.in_flight = set()
+        self.submitted = set()
+        self.timer.timeout.connect(Profiler.slot('auto_accept', self.tick), QtCore.Qt.QueuedConnection)
+
+    def configure(self, sa, trades, markets):
+        if sa is not self.sa:
+            self.submitted.clear()
+        self.sa = sa
+        self.trades = trades
+        self.markets = markets
+        if trades or markets:
+            if not self.timer.isActive():
+                self.timer.start()
+        else:
+            self.timer.stop()
+            self.pending = False
+
+    def tick(self):
+        if self.running:
+            self.pending = True
+            return
+        self.start_poll()
+
+    def start_poll(self):
+        # Timer ticks poll on a worker thread, so slow requests, retries and their backoff never block the window
+        self.pending = False
+        if not self.sa:
+            return
+        # Made here so that its ready signal is queued to the GUI thread
+        ConfirmationHandler.details_cache(self.sa)
+        self.running = True
+        self.worker = Common.CallWorker(self.poll, (self.sa, self.trades, self.markets), {})
+        self.worker.finished.connect(self.poll_finished, QtCore.Qt.QueuedConnection)
+        self.worker.start()
+
+    def poll(self, sa, trades, markets):
+        # Runs on the worker thread: the cheap probe first, and never a login prompt
+        if not ConfirmationHandler.needs_fetch(sa):
+            return True
+        AccountHandler.refresh_session(sa, False)
+        return self.submit(sa, trades, markets, False)
+
+    def poll_finished(self):
+        worker, self.worker = self.worker, None
+        self.running = False
+        if isinstance(worker.error, AccountHandler.SessionExpired):
+            # Polling stops rather than waiting behind a login dialog; Accept All, switching accounts or toggling
+            # auto-accept starts it again
+            self.timer.stop()
+            self.pending = False
+            Common.notify('Steam session of {0} expired. Auto-accept is paused until you sign back in with Accept '
+                          'All.'.format(Metrics.account_label(worker.args[0])), 'Warning')
+        elif worker.error is not None:
+            # Raising from a queued slot would abort the app; the next tick simply tries again
+            Common.notify('Auto-accept for {0} failed: {1}: {2}'.format(Metrics.account_label(worker.args[0]),
+                                                                       type(worker.error).__name__, worker.error),
+                          'Warning')
+        if self.pending and self.timer.isActive():
+            self.start_poll()
+
+    def accept_all(self, trades=True, markets=True, others=True):
+        # The Accept All button; may ask for a login, which also resumes a paused auto-accept
+        if self.running or not self.sa:
+            return None
+        self.running = True
+        sa = self.sa
+        try:
+            if AccountHandler.refresh_session(sa) and (self.trades or self.markets) and not self.timer.isActive():
+                self.timer.start()
+            return self.submit(sa, trades, markets, others)
+        finally:
+            self.running = False
+
+    def submit(self, sa, trades, markets, others):
+        confs = ConfirmationHandler.fetch_confirmations(sa)
+        # Forget ids Steam no longer lists; anything still listed was already handled by a previous run
+        self.submitted.intersection_update(confs.ids())
+        confs = ConfirmationHandler.filter_confirmations(confs, trades, markets, others,
+                                                         self.details_filter) - self.submitted
+        confs = confs - self.in_flight
+        if len(confs) == 0:
+            return True
+        ids = set(confs.ids())
+        self.in_flight.update(ids)
+        try:
+            success = ConfirmationHandler.confirm_multi(sa, confs, 'allow')
+        finally:
+            self.in_flight.difference_update(ids)
+        if success:
+            self.submitted.update(ids)
+        return success
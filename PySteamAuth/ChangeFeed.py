@@ -0,0 +1,223 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import abc
+import collections
+import json
+import shlex
+import socket
+import subprocess
+import threading
+import time
+
+import requests
+
+import Common
+import Metrics
+
+
+class Subscriber(abc.ABC):
+    # Events are queued per subscriber and delivered in batches from its own thread, so a slow hook never holds up
+    # polling. A failed batch is put back and retried with backoff; once the queue is full the oldest events are
+    # dropped and counted.
+    def __init__(self, name, queue_size=1000, batch_size=100, batch_interval=0.5):
+        self.name = name
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        threading.Thread(target=self.loop, name='ChangeFeed-' + name, daemon=True).start()
+
+    def publish(self, events):
+        dropped = 0
+        with self.condition:
+            for i in events:
+                if len(self.queue) >= self.queue_size:
+                    self.queue.popleft()
+                    dropped += 1
+                self.queue.append(i)
+            self.condition.notify()
+        if dropped:
+            Metrics.feed_events.inc(dropped, subscriber=self.name, outcome='dropped')
+
+    def loop(self):
+        backoff = 0
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                waiting = len(self.queue) < self.batch_size
+            # Lets the rest of a burst arrive so that it goes out as one batch
+            if waiting:
+                time.sleep(self.batch_interval)
+            with self.condition:
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            try:
+                self.deliver(batch)
+            except (OSError, ValueError, requests.exceptions.RequestException, subprocess.SubprocessError):
+                Metrics.feed_events.inc(len(batch), subscriber=self.name, outcome='failed')
+                with self.condition:
+                    self.queue.extendleft(reversed(batch[:max(self.queue_size - len(self.queue), 0)]))
+                backoff = min(backoff * 2 or 1, 60)
+                time.sleep(backoff)
+                continue
+            backoff = 0
+            Metrics.feed_events.inc(len(batch), subscriber=self.name, outcome='delivered')
+
+    @abc.abstractmethod
+    def deliver(self, batch):
+        pass
+
+
+class WebhookSubscriber(Subscriber):
+    # POSTs {"events": [...]} to a local URL
+    def __init__(self, url, **kwargs):
+        self.url = url
+        super().__init__('webhook', **kwargs)
+
+    def deliver(self, batch):
+        requests.post(self.url, json={'events': batch}, timeout=10).raise_for_status()
+
+
+class CommandSubscriber(Subscriber):
+    # Runs the command once per batch with the events as JSON lines on stdin
+    def __init__(self, command, **kwargs):
+        self.command = shlex.split(command) if isinstance(command, str) else list(command)
+        super().__init__('command', **kwargs)
+
+    def deliver(self, batch):
+        subprocess.run(self.command, input=''.join(json.dumps(i) + '\n' for i in batch).encode('utf-8'),
+                       stdout=subprocess.DEVNULL, timeout=60, check=True)
+
+
+class SocketSubscriber(Subscriber):
+    # Streams events as JSON lines to every client connected to a local TCP port. Clients only see events published
+    # while they are connected; one that cannot keep up for timeout seconds is disconnected.
+    def __init__(self, host, port, timeout=5, **kwargs):
+        self.timeout = timeout
+        self.clients = []
+        self.clients_lock = threading.Lock()
+        self.server = socket.socket()
+        try:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind((host, port))
+            self.server.listen()
+        except OSError:
+            self.server.close()
+            raise
+        threading.Thread(target=self.accept, name='ChangeFeed-socket-accept', daemon=True).start()
+        super().__init__('socket', **kwargs)
+
+    def accept(self):
+        while True:
+            conn = self.server.accept()[0]
+            conn.settimeout(self.timeout)
+            with self.clients_lock:
+                self.clients.append(conn)
+
+    def deliver(self, batch):
+        data = ''.join(json.dumps(i) + '\n' for i in batch).encode('utf-8')
+        with self.clients_lock:
+            clients = list(self.clients)
+        for conn in clients:
+            try:
+                conn.sendall(data)
+            except OSError:
+                with self.clients_lock:
+                    self.clients.remove(conn)
+                conn.close()
+
+
+def conf_event(event, account, conf):
+    return {'event': event, 'account': account, 'id': conf.id, 'type': conf.type, 'creator': conf.creator,
+            'description': conf.description, 'sub_description': conf.sub_description, 'time': conf.time,
+            'ts': round(time.time(), 3)}
+
+
+# Each fetch is compared with the previous one for the same account: ids that appeared are published as "new" and ids
+# that disappeared as "vanished", unless we accepted or denied them ourselves, which was already published as "acted".
+# The first fetch of an account after startup reports everything pending as new.
+class ChangeFeed(object):
+    def __init__(self, subscribers):
+        self.subscribers = subscribers
+        self.known = {}
+        self.acted_ids = {}
+        self.lock = threading.Lock()
+
+    def publish(self, events):
+        if events:
+            for i in self.subscribers:
+                i.publish(events)
+
+    def observe(self, account, confs):
+        with self.lock:
+            previous = self.known.get(account, {})
+            current = {i.id: i for i in confs}
+            acted_ids = self.acted_ids.get(account, set())
+            events = [conf_event('new', account, conf) for conf_id, conf in current.items() if conf_id not in previous]
+            events.extend(conf_event('vanished', account, conf) for conf_id, conf in previous.items()
+                          if conf_id not in current and conf_id not in acted_ids)
+            self.known[account] = current
+            self.acted_ids[account] = acted_ids & current.keys()
+        self.publish(events)
+
+    def acted(self, account, conf, action, outcome):
+        if outcome == 'success':
+            with self.lock:
+                self.acted_ids.setdefault(account, set()).add(conf.id)
+        event = conf_event('acted', account, conf)
+        event.update({'action': action, 'outcome': outcome})
+        self.publish([event])
+
+
+feed = None
+
+
+def configure(config, shard=None):
+    # Off unless the manifest has eg. "change_feed": {"webhook": "http://127.0.0.1:8080/psa", "command": "./on-trade",
+    # "socket": 8765, "queue_size": 1000, "batch_size": 100, "batch_interval": 0.5}. Like the metrics port, shard
+    # worker N listens on the socket port plus N + 1. A port that is already taken only skips the socket subscriber.
+    global feed
+    if not config or feed is not None:
+        return feed
+    kwargs = {i: config[i] for i in ['queue_size', 'batch_size', 'batch_interval'] if i in config}
+    subscribers = []
+    if config.get('webhook'):
+        subscribers.append(WebhookSubscriber(config['webhook'], **kwargs))
+    if config.get('command'):
+        subscribers.append(CommandSubscriber(config['command'], **kwargs))
+    if config.get('socket'):
+        host, port = str(config['socket']).rpartition(':')[::2]
+        port = int(port) + (shard + 1 if shard is not None else 0)
+        try:
+            subscribers.append(SocketSubscriber(host or '127.0.0.1', port, **kwargs))
+        except OSError as e:
+            Common.notify('Could not listen on port {0}: {1}'.format(port, e), 'Change feed')
+    feed = ChangeFeed(subscribers)
+    return feed
+
+
+def observe(account, confs, page):
+    # An error or login page parses to no confirmations too; only a real empty list may mark everything vanished
+    if feed is None or (not len(confs) and '<div>Nothing to confirm</div>' not in page):
+        return
+    feed.observe(account, confs)
+
+
+def acted(account, conf, action, outcome):
+    if feed is not None:
+        feed.acted(account, conf, action, outcome)
@@ -13,19 +13,211 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from PyQt5 import QtWidgets
+import sys
+import importlib
+import os
+import threading
+import time
 
+from PyQt5 import QtWidgets, QtCore
+
+import DialogHandler
 import PyUIs
 
 
+class NotificationCenter(QtCore.QObject):
+    # Non-modal replacement for error_popup in code that runs in the background (timers, polling, workers).
+    # Repeats of the same message within repeat_interval are only counted, and at most burst_limit distinct
+    # messages are shown per burst_interval; the ones over the limit are summed up in one message once the burst
+    # is over. notify() may be called from any thread; display is queued to the thread that owns this object. Without
+    # a QApplication (eg. --supervise) there is no event loop to queue to, so messages go straight to stderr.
+    message = QtCore.pyqtSignal(str, str)
+
+    def __init__(self, repeat_interval=60, burst_limit=3, burst_interval=10, display_time=15000):
+        super().__init__()
+        self.repeat_interval = repeat_interval
+        self.burst_limit = burst_limit
+        self.burst_interval = burst_interval
+        self.display_time = display_time
+        self.status_bar = None
+        self.last_shown = {}
+        self.suppressed = {}
+        self.recent = []
+        self.overflow = []
+        self.headless_lock = threading.Lock()
+        self.overflow_timer = None
+        self.message.connect(self._show, QtCore.Qt.QueuedConnection)
+
+    def attach(self, status_bar):
+        self.status_bar = status_bar
+
+    def notify(self, message, header=None):
+        if QtCore.QCoreApplication.instance() is None:
+            with self.headless_lock:
+                self._show(str(message), str(header) if header else '')
+            return
+        self.message.emit(str(message), str(header) if header else '')
+
+    def _show(self, message, header):
+        now = time.monotonic()
+        key = (header, message)
+        last = self.last_shown.get(key)
+        self.recent = [i for i in self.recent if now - i < self.burst_interval]
+        if not self.recent:
+            self._show_overflow()
+        if last is not None and now - last < self.repeat_interval:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return
+        if len(self.recent) >= self.burst_limit:
+            self.overflow.append(key)
+            self._schedule_overflow(self.recent[0] + self.burst_interval - now)
+            return
+        self.last_shown[key] = now
+        self.recent.append(now)
+        text = (header.strip(' :') + ': ' + message) if header.strip(' :') else message
+        repeats = self.suppressed.pop(key, 0)
+        if repeats:
+            text += ' (repeated {0} more times)'.format(repeats)
+        self._display(text)
+
+    def _schedule_overflow(self, delay):
+        # Headless, the summary waits for the next message instead
+        if QtCore.QCoreApplication.instance() is None or (self.overflow_timer and self.overflow_timer.isActive()):
+            return
+        if self.overflow_timer is None:
+            self.overflow_timer = QtCore.QTimer(self)
+            self.overflow_timer.setSingleShot(True)
+            self.overflow_timer.timeout.connect(self._show_overflow)
+        self.overflow_timer.start(max(0, int(delay * 1000)))
+
+    def _show_overflow(self):
+        overflow, self.overflow = self.overflow, []
+        if not overflow:
+            return
+        header, message = overflow[-1]
+        text = (header.strip(' :') + ': ' + message) if header.strip(' :') else message
+        if len(overflow) > 1:
+            text += ' ({0} more notifications were suppressed)'.format(len(overflow) - 1)
+        self.last_shown[overflow[-1]] = time.monotonic()
+        self._display(text)
+
+    def _display(self, text):
+        if self.status_bar is not None:
+            self.status_bar.showMessage(text, self.display_time)
+        else:
+            print(text, file=sys.stderr)
+
+
+notifications = None
+resources_loaded = False
+
+
+def notification_center():
+    global notifications
+    if notifications is None:
+        notifications = NotificationCenter()
+    return notifications
+
+
+def notify(message, header=None):
+    notification_center().notify(message, header)
+
+
+def load_resources():
+    # Icons are only used by a few dialogs, so they are registered on first use. A binary Images.rcc (make.py
+    # --qt-rcc) is memory-mapped by Qt; otherwise the compiled Images_rc module is imported.
+    global resources_loaded
+    if resources_loaded:
+        return
+    rcc_path = os.path.join(os.path.dirname(os.path.abspath(PyUIs.__file__)), 'Images.rcc')
+    if not (os.path.isfile(rcc_path) and QtCore.QResource.registerResource(rcc_path)):
+        importlib.import_module('PyUIs.Images_rc')
+    resources_loaded = True
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CallWorker(QtCore.QThread):
+    def __init__(self, func, args, kwargs):
+        super().__init__()
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+
+
+# Workers whose caller stopped waiting are kept referenced until their thread ends
+abandoned_workers = set()
+
+
+class ProgressDialog(QtWidgets.QProgressDialog):
+    # Without a cancel button, Escape and the close button are ignored as well
+    def __init__(self, text, cancellable):
+        super().__init__(text, 'Cancel' if cancellable else None, 0, 0)
+        self.cancellable = cancellable
+
+    def reject(self):
+        if self.cancellable:
+            super().reject()
+
+    def closeEvent(self, event):
+        if self.cancellable:
+            super().closeEvent(event)
+        else:
+            event.ignore()
+
+
+def run_in_background(func, *args, text='Contacting Steam...', cancellable=True, **kwargs):
+    # Runs a blocking call (a Steam round-trip) on a worker thread while a progress dialog keeps the UI responsive, so
+    # a flow can stay written step by step with dialogs only collecting input. Returns the call's result or re-raises
+    # its exception. Raises Cancelled if the user stops waiting; the call then finishes in the background and its
+    # result is dropped. Calls that change the account on Steam must not be abandoned like that; see
+    # run_to_completion.
+    worker = CallWorker(func, args, kwargs)
+    progress = ProgressDialog(text, cancellable)
+    progress.setWindowTitle('Please wait')
+    progress.setWindowModality(QtCore.Qt.ApplicationModal)
+    progress.setMinimumDuration(300)
+    progress.setValue(0)  # starts the minimum duration timer, so quick calls never flash the dialog
+    loop = QtCore.QEventLoop()
+    if cancellable:
+        progress.canceled.connect(loop.quit)
+    worker.finished.connect(loop.quit)
+    worker.start()
+    loop.exec_()
+    if cancellable:
+        progress.canceled.disconnect()
+    progress.hide()
+    progress.deleteLater()
+    if not worker.isFinished():
+        abandoned_workers.add(worker)
+        worker.finished.connect(lambda: abandoned_workers.discard(worker))
+        raise Cancelled()
+    if worker.error is not None:
+        raise worker.error
+    return worker.result
+
+
+def run_to_completion(func, *args, **kwargs):
+    # For steps that change the account on Steam (adding or removing the authenticator, finalizing, phone numbers,
+    # backup codes): the dialog has no cancel button and the flow always gets the outcome
+    return run_in_background(func, *args, cancellable=False, **kwargs)
+
+
 def error_popup(message, header=None):
-    error_dialog = QtWidgets.QDialog()
-    error_ui = PyUIs.ErrorDialog.Ui_Dialog()
-    error_ui.setupUi(error_dialog)
+    error_dialog = DialogHandler.get_dialog(PyUIs.ErrorDialog.Ui_Dialog)
+    error_ui = error_dialog.ui
     if header:
         error_ui.header.setText(str(header))
         error_dialog.setWindowTitle(str(header))
     error_ui.errorBox.setText(str(message))
     error_dialog.exec_()
-    error_dialog.close()
-    error_dialog.deleteLater()
@@ -13,34 +13,59 @@
 import requests
 import requests.cookies
 import base64
+import concurrent.futures
+import html
 import json
 import re
+import threading
+import time
 
+from PyQt5 import QtCore
+
+import AuditLog
+import ChangeFeed
 import Common
+import Metrics
+import RequestHandler
 
 
 class Empty:
     pass
 
 
+CONFIRMATION_TYPES = {
+    1: 'Generic',
+    2: 'Trade',
+    3: 'Market Listing',
+    5: 'Steam Details Change'
+}
+
+
+ACTION_NAMES = {
+    'allow': 'accepted',
+    'cancel': 'denied'
+}
+
+
 class Confirmation(object):
+    __slots__ = ('id', 'key', 'type', 'creator', 'icon_url', 'description', 'sub_description', 'time', 'details')
+
     def __init__(self, conf_id, conf_key, conf_type, conf_creator, conf_icon_url, conf_description,
                  conf_sub_description, conf_time):
         self.id = conf_id
         self.key = conf_key
         self.type = int(conf_type)
-        type_switch = {
-            1: 'Generic',
-            2: 'Trade',
-            3: 'Market Listing',
-            5: 'Steam Details Change'
-        }
         self.icon_url = conf_icon_url
-        self.type_str = type_switch.get(self.type, 'Unknown')
         self.creator = conf_creator
         self.description = conf_description
         self.sub_description = conf_sub_description
         self.time = conf_time
+        # Plain text of the details page; filled in by the DetailsCache once it has been fetched
+        self.details = None
+
+    @property
+    def type_str(self):
+        return CONFIRMATION_TYPES.get(self.type, 'Unknown')
 
     def accept(self, sa):
         return confirm(sa, self, 'allow')
@@ -49,6 +74,261 @@ class Confirmation(object):
         return confirm(sa, self, 'cancel')
 
 
+class ConfirmationSet(object):
+    # Confirmations in fetch order, indexed by id, type and creator. The type and creator buckets are dicts
+    # keyed by id so that removal stays O(1) everywhere.
+    __slots__ = ('_by_id', '_by_type', '_by_creator')
+
+    def __init__(self, confs=()):
+        self._by_id = {}
+        self._by_type = {}
+        self._by_creator = {}
+        for i in confs:
+            self.add(i)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def __contains__(self, conf):
+        return getattr(conf, 'id', conf) in self._by_id
+
+    def __sub__(self, other):
+        return ConfirmationSet(i for i in self if i.id not in other)
+
+    def __repr__(self):
+        return 'ConfirmationSet({0})'.format(list(self._by_id))
+
+    def add(self, conf):
+        self.discard(conf)
+        self._by_id[conf.id] = conf
+        self._by_type.setdefault(conf.type, {})[conf.id] = conf
+        self._by_creator.setdefault(conf.creator, {})[conf.id] = conf
+
+    def discard(self, conf):
+        conf = self._by_id.pop(getattr(conf, 'id', conf), None)
+        if conf is None:
+            return None
+        for index, key in ((self._by_type, conf.type), (self._by_creator, conf.creator)):
+            bucket = index[key]
+            del bucket[conf.id]
+            if not bucket:
+                del index[key]
+        return conf
+
+    def remove(self, conf):
+        if self.discard(conf) is None:
+            raise KeyError(getattr(conf, 'id', conf))
+
+    def get(self, conf_id, default=None):
+        return self._by_id.get(conf_id, default)
+
+    def at(self, index):
+        if index < 0:
+            index += len(self._by_id)
+        if not 0 <= index < len(self._by_id):
+            raise IndexError('confirmation index out of range')
+        for n, conf in enumerate(self._by_id.values()):
+            if n == index:
+                return conf
+
+    def ids(self):
+        return self._by_id.keys()
+
+    def types(self):
+        return self._by_type.keys()
+
+    def of_types(self, types):
+        ret = ConfirmationSet()
+        for i in types:
+            for conf in self._by_type.get(i, {}).values():
+                ret.add(conf)
+        return ret
+
+    def by_creator(self, creator):
+        return ConfirmationSet(self._by_creator.get(creator, {}).values())
+
+
+def filter_confirmations(confs, trades=True, markets=True, others=True, details_filter=None):
+    # details_filter is called with each confirmation whose details have arrived; the rest are left for a later run
+    if details_filter:
+        confs = ConfirmationSet(i for i in confs if i.details is not None and details_filter(i))
+    types = set(confs.types())
+    if not trades:
+        types.discard(2)
+    if not markets:
+        types.discard(3)
+    if not others:
+        types &= {2, 3}
+    if len(types) == len(confs.types()):
+        return confs
+    return confs.of_types(types)
+
+
+def details_rule(config):
+    # Builds the auto-accept details_filter from the manifest, eg.
+    # "auto_accept_rules": {"accept_if": "You will receive", "reject_if": "Steam Gift Card|escrow"}; both are
+    # case-insensitive regexes searched in the details text. A broken rule accepts nothing rather than everything.
+    if not config:
+        return None
+    try:
+        accept_if = re.compile(config['accept_if'], re.I) if config.get('accept_if') else None
+        reject_if = re.compile(config['reject_if'], re.I) if config.get('reject_if') else None
+    except (re.error, TypeError, AttributeError) as e:
+        Common.notify('Invalid auto_accept_rules ({0}); auto-accept will not accept anything.'.format(e), 'Warning')
+        return lambda conf: False
+    return lambda conf: ((accept_if is None or accept_if.search(conf.details) is not None) and
+                         (reject_if is None or reject_if.search(conf.details) is None))
+
+
+class DetailsCache(QtCore.QObject):
+    # Details pages of one account's confirmations, keyed by id. Every fetched list starts background requests for the
+    # ids not seen yet, and ids that drop off the list are forgotten. ready is emitted with the id once its details
+    # are in, queued to the thread that created the cache.
+    ready = QtCore.pyqtSignal(str)
+
+    def __init__(self, max_workers=4):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.details = {}
+        self.pending = {}
+        self.confs = ConfirmationSet()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def update(self, sa, confs):
+        with self.lock:
+            self.confs = confs
+            for i in [i for i in self.details if i not in confs]:
+                del self.details[i]
+            for i in [i for i in self.pending if i not in confs]:
+                self.pending.pop(i).cancel()
+            for conf in confs:
+                if conf.id in self.details:
+                    conf.details = self.details[conf.id]
+                elif conf.id not in self.pending:
+                    self.pending[conf.id] = self.pool.submit(self.fetch, sa, conf.id)
+
+    def is_pending(self, conf_id):
+        return conf_id in self.pending
+
+    def fetch(self, sa, conf_id):
+        details = fetch_details(sa, conf_id)
+        with self.lock:
+            # Failures are not cached, so the next list fetch tries again
+            if self.pending.pop(conf_id, None) is None or details is None:
+                return
+            self.details[conf_id] = details
+            conf = self.confs.get(conf_id)
+            if conf is not None:
+                conf.details = details
+        self.ready.emit(conf_id)
+
+
+details_caches = {}
+
+
+def details_cache(sa):
+    steamid = str(sa.secrets['Session']['SteamID'])
+    if steamid not in details_caches:
+        details_caches[steamid] = DetailsCache()
+    return details_caches[steamid]
+
+
+# Steam's notification counts move when a trade offer or new items arrive, so an unchanged count after an empty list
+# is a hint that the list is still empty. Offers the account sends itself and market listings, which need the most
+# confirmations, don't move the counts though, which is why a full fetch is still made every max_skip seconds. Those
+# confirmations can wait up to max_skip seconds instead of one poll interval, so probing is off unless the manifest
+# asks for it. Outcomes are counted per account in pysteamauth_pending_probes_total; "skipped" are the saved fetches.
+class PendingProbe(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.signature = None
+        self.next_signature = None
+        self.empty = False
+        self.fetched_at = None
+
+    def check(self, account, signature):
+        # Returns whether the full list has to be fetched
+        with self.lock:
+            self.next_signature = signature
+            if signature is None:
+                outcome = 'unavailable'
+            elif not self.empty:
+                # The last list had confirmations, or none has been fetched yet
+                outcome = 'pending'
+            elif time.monotonic() - self.fetched_at >= probe_max_skip:
+                outcome = 'stale'
+            elif signature != self.signature:
+                outcome = 'changed'
+            else:
+                outcome = 'skipped'
+        Metrics.pending_probes.inc(account=account, outcome=outcome)
+        return outcome != 'skipped'
+
+    def fetched(self, confs, page):
+        # Only a real "Nothing to confirm" page counts as empty, never an error or login page
+        with self.lock:
+            self.signature, self.next_signature = self.next_signature, None
+            self.empty = not len(confs) and '<div>Nothing to confirm</div>' in page
+            self.fetched_at = time.monotonic()
+
+
+pending_probes = {}
+# Seconds a probe may stand in for the full fetch; 0 (the default) turns probing off
+probe_max_skip = 0
+
+
+def configure_probe(config):
+    # Opt-in from the manifest, eg. "pending_probe": true for max_skip 15, or "pending_probe": {"max_skip": 30}
+    global probe_max_skip
+    if not config:
+        probe_max_skip = 0
+    else:
+        probe_max_skip = (config if isinstance(config, dict) else {}).get('max_skip', 15)
+
+
+def pending_probe(sa):
+    steamid = str(sa.secrets['Session']['SteamID'])
+    if steamid not in pending_probes:
+        pending_probes[steamid] = PendingProbe()
+    return pending_probes[steamid]
+
+
+def notification_signature(page):
+    try:
+        counts = json.loads(page)['notifications']
+        return tuple(sorted((str(k), int(v)) for k, v in counts.items()))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def fetch_notification_signature(sa):
+    try:
+        r = RequestHandler.request('actions/GetNotificationCounts', 'GET',
+                                   'https://steamcommunity.com/actions/GetNotificationCounts',
+                                   account=Metrics.account_label(sa), cookies=generate_cookiejar(sa))
+    except requests.exceptions.RequestException:
+        return None
+    return notification_signature(r.text) if r.status_code == 200 else None
+
+
+def needs_fetch(sa):
+    # The cookie-only probe used by the auto-accept poller before refreshing the session and the signed
+    # mobileconf/conf fetch; an expired session makes the probe fail, which leads to the refresh
+    if not probe_max_skip:
+        return True
+    return pending_probe(sa).check(Metrics.account_label(sa), fetch_notification_signature(sa))
+
+
+def html_to_text(page):
+    page = re.sub(r'(?is)<(script|style)[^>]*>.*?</\1>', '', page)
+    page = re.sub(r'(?i)<br\s*/?>|</(div|p|tr)>', '\n', page)
+    lines = (' '.join(html.unescape(i).split()) for i in re.sub('<[^<]+?>', ' ', page).split('\n'))
+    return '\n'.join(i for i in lines if i)
+
+
 def generate_query(tag, sa):
     return {'op': tag, 'p': sa.secrets['device_id'], 'a': sa.secrets['Session']['SteamID'],
             'k': base64.b64encode(sa.get_confirmation_key(tag)).decode('utf-8'), 't': sa.get_time(),
@@ -72,10 +352,11 @@ def fetch_confirmations(sa):
     data = generate_query('conf', sa)
     jar = generate_cookiejar(sa)
     try:
-        r = requests.get(url, params="&".join("%s=%s" % (k, v) for k, v in data.items()), cookies=jar, )
-    except requests.exceptions.ConnectionError:
-        Common.error_popup('Connection Error.')
-        return []
+        r = RequestHandler.request('mobileconf/conf', 'GET', url, account=Metrics.account_label(sa),
+                                   params="&".join("%s=%s" % (k, v) for k, v in data.items()), cookies=jar)
+    except requests.exceptions.RequestException:
+        Common.notify('Connection error while fetching confirmations.')
+        return ConfirmationSet()
     # except requests.exceptions.InvalidSchema:
     #     TODO Finish this
     #     pass
@@ -85,32 +366,69 @@ def fetch_confirmations(sa):
     #     r = Empty()
     #     r.text = f.read()
 
-    if '<div>Nothing to confirm</div>' in r.text:
-        return []
-    ret = []
+    ret = parse_confirmations(r.text)
+    Metrics.confirmations.inc(len(ret), account=Metrics.account_label(sa), action='fetched')
+    ChangeFeed.observe(Metrics.account_label(sa), ret, r.text)
+    pending_probe(sa).fetched(ret, r.text)
+    details_cache(sa).update(sa, ret)
+    return ret
+
+
+def parse_confirmations(page):
+    # Shared by the sync and asyncio APIs
+    ret = ConfirmationSet()
+    if '<div>Nothing to confirm</div>' in page:
+        return ret
     pattern = '<div class=\"mobileconf_list_entry\" id=\"conf[0-9]+\" data-confid=\"(\d+)\" data-key=\"(\d+)\" ' \
               'data-type=\"(\d)\" data-creator=\"(\d+)\" data-cancel=\"[a-zA-Z]+\" data-accept=\"[a-zA-Z]+\" >' \
               '[\s]*?<div class=\"mobileconf_list_entry_content\">[\s]*?<div class=\"mobileconf_list_entry_icon\">' \
               '[\s]*?(?:<div class=\"[a-zA-Z ]+\"><img src=\"(.*?)\" srcset=\".*? 1x, .*? 2x\"></div>)?[\s]*?</div>' \
               '[\s]*?<div class=\"mobileconf_list_entry_description\">[\s]*?<div>(.*?)</div>[\s]*?<div>(.*?)</div>' \
               '[\s]*?<div>(.*?)</div>[\s]*?</div>[\s]*?</div>'
-    for i in re.findall(pattern, r.text):
-        ret.append(Confirmation(i[0], i[1], i[2], i[3], i[4].replace('.jpg', '_full.jpg'), re.sub('<[^<]+?>', '', i[5]),
-                                i[6], i[7]))
+    for i in re.findall(pattern, page):
+        ret.add(Confirmation(i[0], i[1], i[2], i[3], i[4].replace('.jpg', '_full.jpg'), re.sub('<[^<]+?>', '', i[5]),
+                             i[6], i[7]))
     return ret
 
 
+def fetch_details(sa, conf_id):
+    url = 'https://steamcommunity.com/mobileconf/details/' + conf_id
+    data = generate_query('details', sa)
+    jar = generate_cookiejar(sa)
+    try:
+        r = RequestHandler.request('mobileconf/details', 'GET', url, account=Metrics.account_label(sa),
+                                   params="&".join("%s=%s" % (k, v) for k, v in data.items()), cookies=jar)
+        ret = json.loads(r.text)
+    except (requests.exceptions.RequestException, json.decoder.JSONDecodeError):
+        return None
+    if not ret.get('success') or 'html' not in ret:
+        return None
+    return html_to_text(ret['html'])
+
+
 def confirm(sa, conf, action):
     url = 'https://steamcommunity.com/mobileconf/ajaxop'
     data = generate_query(action, sa)
     data.update({'cid': conf.id, 'ck': conf.key})
     jar = generate_cookiejar(sa)
+    pre_time = time.time()
     try:
-        r = requests.get(url, params="&".join("%s=%s" % (k, v) for k, v in data.items()), cookies=jar)
-    except (requests.exceptions.ConnectionError, json.decoder.JSONDecodeError):
-        Common.error_popup('Connection error.')
+        r = RequestHandler.request('mobileconf/ajaxop', 'GET', url, idempotent=False,
+                                   account=Metrics.account_label(sa),
+                                   params="&".join("%s=%s" % (k, v) for k, v in data.items()), cookies=jar)
+        success = json.loads(r.text)["success"]
+    except (requests.exceptions.RequestException, json.decoder.JSONDecodeError, KeyError):
+        AuditLog.record(Metrics.account_label(sa), conf, ACTION_NAMES.get(action, action), 'error',
+                        time.time() - pre_time)
+        ChangeFeed.acted(Metrics.account_label(sa), conf, ACTION_NAMES.get(action, action), 'error')
+        Common.notify('Connection error while sending confirmation.')
         return False
-    if json.loads(r.text)["success"]:
+    AuditLog.record(Metrics.account_label(sa), conf, ACTION_NAMES.get(action, action),
+                    'success' if success else 'rejected', time.time() - pre_time)
+    ChangeFeed.acted(Metrics.account_label(sa), conf, ACTION_NAMES.get(action, action),
+                     'success' if success else 'rejected')
+    if success:
+        Metrics.confirmations.inc(account=Metrics.account_label(sa), action=ACTION_NAMES.get(action, action))
         return True
     else:
         return False
@@ -119,16 +437,29 @@ def confirm(sa, conf, action):
 def confirm_multi(sa, confs, action):
     url = 'https://steamcommunity.com/mobileconf/multiajaxop'
     data = generate_query(action, sa)
-    for i in confs:
-        data.update({'cid[]': i.id, 'ck[]': i.key})
+    data.update({'cid[]': [i.id for i in confs], 'ck[]': [i.key for i in confs]})
     jar = generate_cookiejar(sa)
+    pre_time = time.time()
     try:
-        r = requests.post(url, data=data, cookies=jar)
-    except (requests.exceptions.ConnectionError, json.decoder.JSONDecodeError):
-        Common.error_popup('Connection error.')
+        r = RequestHandler.request('mobileconf/multiajaxop', 'POST', url, idempotent=False,
+                                   account=Metrics.account_label(sa), data=data, cookies=jar)
+        success = json.loads(r.text)["success"]
+        outcome = 'success' if success else 'rejected'
+    except (requests.exceptions.RequestException, json.decoder.JSONDecodeError, KeyError):
+        success = None
+        outcome = 'error'
+    # One record per confirmation, all sharing the latency of the batch request
+    for conf in confs:
+        AuditLog.record(Metrics.account_label(sa), conf, ACTION_NAMES.get(action, action), outcome,
+                        time.time() - pre_time)
+        ChangeFeed.acted(Metrics.account_label(sa), conf, ACTION_NAMES.get(action, action), outcome)
+    if success is None:
+        Common.notify('Connection error while sending confirmations.')
         return False
-    if json.loads(r.text)["success"]:
+    if success:
+        Metrics.confirmations.inc(len(confs), account=Metrics.account_label(sa),
+                                  action=ACTION_NAMES.get(action, action))
         return True
     else:
-        Common.error_popup('Confirmation error.')
+        Common.notify('Steam rejected the confirmations.')
         return False
@@ -0,0 +1,109 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+
+from PyQt5 import QtCore, QtWidgets
+from steam import guard
+
+import PyUIs
+import Profiler
+
+
+class CodeTableModel(QtCore.QAbstractTableModel):
+    headers = ['Account Name', 'SteamID', 'Code']
+
+    def __init__(self, accounts, parent=None):
+        # accounts is a list of (account_name, steamid, decoded shared_secret) tuples
+        super().__init__(parent)
+        self.accounts = accounts
+        self.codes = [''] * len(accounts)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.accounts)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole:
+            if index.column() == 2:
+                return self.codes[index.row()]
+            return self.accounts[index.row()][index.column()]
+        if role == QtCore.Qt.TextAlignmentRole and index.column() == 2:
+            return QtCore.Qt.AlignCenter
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def update_codes(self, timestamp):
+        self.codes = [guard.generate_twofactor_code_for_time(i[2], timestamp) for i in self.accounts]
+        if self.accounts:
+            self.dataChanged.emit(self.index(0, 2), self.index(len(self.accounts) - 1, 2), [QtCore.Qt.DisplayRole])
+
+
+class Dashboard(object):
+    # Codes for every account are generated in one batch per 30 second window. The timer is re-armed as a single
+    # shot to the next window edge each time, so it never drifts and nothing runs between edges.
+    def __init__(self, accounts, time_offset=0, parent=None):
+        self.time_offset = time_offset
+        self.dialog = QtWidgets.QDialog(parent)
+        self.ui = PyUIs.DashboardDialog.Ui_Dialog()
+        self.ui.setupUi(self.dialog)
+        self.model = CodeTableModel(accounts, self.dialog)
+        self.proxy = QtCore.QSortFilterProxyModel(self.dialog)
+        self.proxy.setSourceModel(self.model)
+        self.proxy.setFilterCaseSensitivity(QtCore.Qt.CaseInsensitive)
+        self.proxy.setFilterKeyColumn(-1)
+        self.ui.codeTable.setModel(self.proxy)
+        self.ui.codeTable.verticalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Fixed)
+        self.ui.codeTable.sortByColumn(0, QtCore.Qt.AscendingOrder)
+        self.ui.codeTable.doubleClicked.connect(self.copy_code)
+        self.ui.searchBox.textChanged.connect(self.set_filter)
+        self.timer = QtCore.QTimer(self.dialog)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self.timer.timeout.connect(Profiler.slot('dashboard_tick', self.tick))
+        self.dialog.finished.connect(lambda r: self.timer.stop())
+        self.update_count()
+
+    def show(self):
+        self.tick()
+        self.dialog.show()
+        self.dialog.raise_()
+
+    def tick(self):
+        now = time.time() + self.time_offset
+        window = int(now) // 30 * 30
+        self.model.update_codes(window)
+        remaining = window + 30 - now
+        self.ui.expiryLabel.setText('Codes change at ' + time.strftime('%H:%M:%S', time.localtime(time.time() +
+                                                                                                   remaining)))
+        # Land just past the edge so the next tick computes codes for the new window
+        self.timer.start(int(remaining * 1000) + 50)
+
+    def set_filter(self, text):
+        self.proxy.setFilterFixedString(text)
+        self.update_count()
+
+    def update_count(self):
+        self.ui.countLabel.setText('{0} of {1} accounts'.format(self.proxy.rowCount(), self.model.rowCount()))
+
+    def copy_code(self, index):
+        QtWidgets.QApplication.clipboard().setText(self.proxy.index(index.row(), 2).data())
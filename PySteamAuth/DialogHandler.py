@@ -0,0 +1,72 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from PyQt5 import QtGui, QtWidgets
+
+
+dialogs = {}
+
+
+class ReusableDialog(QtWidgets.QDialog):
+    # A PyUIs dialog that is built once and restored to its initial state every time it is handed out again.
+    # Connections made with bind() only last for one prompt.
+
+    def __init__(self, ui_class):
+        super().__init__()
+        self.ui = ui_class()
+        self.ui.setupUi(self)
+        self.bindings = []
+        self.title = self.windowTitle()
+        self.labels = [(w, w.text(), QtGui.QPixmap(w.pixmap()) if w.pixmap() else None)
+                       for w in self.findChildren(QtWidgets.QLabel)]
+        self.line_edits = [(w, w.text()) for w in self.findChildren(QtWidgets.QLineEdit)]
+        self.text_edits = [(w, w.toHtml()) for w in self.findChildren(QtWidgets.QTextEdit)]
+        self.widgets = [(w, w.isEnabled()) for w in self.findChildren(QtWidgets.QWidget)]
+
+    def bind(self, signal, slot):
+        signal.connect(slot)
+        self.bindings.append((signal, slot))
+
+    def reset(self):
+        for signal, slot in self.bindings:
+            signal.disconnect(slot)
+        self.bindings = []
+        self.setWindowTitle(self.title)
+        for w, text, pixmap in self.labels:
+            if pixmap:
+                w.setPixmap(pixmap)
+            else:
+                w.setText(text)
+        for w, text in self.line_edits:
+            w.setText(text)
+        for w, html in self.text_edits:
+            w.setHtml(html)
+        for w, enabled in self.widgets:
+            w.setEnabled(enabled)
+        for w, text in self.line_edits[:1]:
+            w.setFocus()
+
+
+def get_dialog(ui_class):
+    # Hands out a reset instance of the dialog. Instances are only reused once hidden, so a prompt opened while another
+    # of the same type is still showing gets its own; read results right after exec_() returns.
+    for dialog in dialogs.setdefault(ui_class, []):
+        if not dialog.isVisible():
+            dialog.reset()
+            return dialog
+    dialog = ReusableDialog(ui_class)
+    dialogs[ui_class].append(dialog)
+    return dialog
@@ -0,0 +1,155 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import contextlib
+import json
+import os
+import sys
+import tempfile
+
+from PyQt5 import QtCore
+
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
+
+# path -> (mtime_ns, size) of the last write made by this process, so the watcher can skip our own changes
+own_writes = {}
+
+
+@contextlib.contextmanager
+def locked(folder, exclusive=True):
+    # Advisory lock on <folder>/.lock, shared by every PySteamAuth process using the folder. Windows only supports
+    # exclusive locks; shared requests are upgraded.
+    with open(os.path.join(folder, '.lock'), 'a+') as lock_file:
+        if sys.platform == 'win32':
+            lock_file.seek(0)
+            while True:
+                # LK_LOCK gives up with OSError after about 10 seconds; keep waiting like flock does
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if sys.platform == 'win32':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def write_json(path, data):
+    # Write to a temporary file and rename over the target so readers never see a partial file. The temporary name is
+    # unique, so concurrent writers never share one.
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+    st = os.stat(path)
+    own_writes[os.path.abspath(path)] = (st.st_mtime_ns, st.st_size)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def is_own_write(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return own_writes.get(os.path.abspath(path)) == (st.st_mtime_ns, st.st_size)
+
+
+class MaFileWatcher(QtCore.QObject):
+    # Watches a maFiles folder and reports which files changed, so that only those entries need reloading.
+    # Events are debounced, and writes made through write_json by this process are ignored.
+    manifest_changed = QtCore.pyqtSignal()
+    mafile_changed = QtCore.pyqtSignal(str)
+    mafile_removed = QtCore.pyqtSignal(str)
+
+    def __init__(self, folder, parent=None, delay=250):
+        super().__init__(parent)
+        self.folder = folder
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.queue)
+        self.watcher.directoryChanged.connect(self.queue)
+        self.pending = set()
+        self.known = set()
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.flush)
+        self.rewatch()
+
+    def stop(self):
+        self.timer.stop()
+        paths = self.watcher.files() + self.watcher.directories()
+        if paths:
+            self.watcher.removePaths(paths)
+
+    def rewatch(self):
+        # Renamed-over files drop out of the watch list, so re-add everything that exists now
+        try:
+            names = set(i for i in os.listdir(self.folder) if i.endswith('.maFile') or i == 'manifest.json')
+        except OSError:
+            names = set()
+        self.known = names
+        paths = [os.path.join(self.folder, i) for i in names] + [self.folder]
+        watched = set(self.watcher.files() + self.watcher.directories())
+        missing = [i for i in paths if i not in watched]
+        if missing:
+            self.watcher.addPaths(missing)
+
+    def queue(self, path):
+        self.pending.add(path)
+        self.timer.start()
+
+    def flush(self):
+        pending, self.pending = self.pending, set()
+        before = self.known
+        self.rewatch()
+        changed = set(os.path.basename(i) for i in pending if i != self.folder)
+        # Directory events cover files that were added or replaced
+        if self.folder in pending:
+            changed |= self.known ^ before
+        for name in sorted(changed):
+            path = os.path.join(self.folder, name)
+            if name not in self.known:
+                if name != 'manifest.json':
+                    self.mafile_removed.emit(name)
+            elif is_own_write(path):
+                continue
+            elif name == 'manifest.json':
+                self.manifest_changed.emit()
+            else:
+                self.mafile_changed.emit(name)
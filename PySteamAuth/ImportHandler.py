@@ -0,0 +1,145 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import shutil
+
+from PyQt5 import QtCore, QtWidgets
+from steam import guard
+
+import FileHandler
+
+
+def read_manifest(folder):
+    try:
+        with open(os.path.join(folder, 'manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest['entries']
+        return manifest
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def read_entries(folder):
+    # Folders without a manifest are imported file by file
+    manifest = read_manifest(folder)
+    if manifest:
+        return manifest, manifest['entries']
+    try:
+        return None, [{'filename': i} for i in sorted(os.listdir(folder)) if i.endswith('.maFile')]
+    except OSError:
+        return None, []
+
+
+def validate_entry(folder, entry):
+    # Same checks as test_mafiles, but with a fixed timestamp so that no Steam time sync is done per file
+    with open(os.path.join(folder, entry['filename'])) as maf_file:
+        maf = json.load(maf_file)
+    sa = guard.SteamAuthenticator(secrets=maf)
+    sa.get_code(timestamp=0)
+    sa.get_confirmation_key('conf', timestamp=0)
+    steamid = entry.get('steamid') or maf.get('steamid') or maf['Session']['SteamID']
+    return int(steamid), maf
+
+
+class ImportWorker(QtCore.QThread):
+    progress = QtCore.pyqtSignal(int, int)
+
+    def __init__(self, source, existing_steamids=()):
+        super().__init__()
+        self.source = source
+        self.existing_steamids = set(int(i) for i in existing_steamids)
+        self.cancelled = False
+        self.source_manifest = None
+        self.valid = []
+        self.duplicates = 0
+        self.invalid = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        # One file after another: validating is CPU-bound Python (well under a millisecond per file), so a thread pool
+        # only contends for the GIL, and worker processes take longer to start (a fresh interpreter each on Windows,
+        # macOS and the frozen build) than a typical folder takes to validate. This thread keeps the UI responsive.
+        self.source_manifest, entries = read_entries(self.source)
+        seen = set(self.existing_steamids)
+        for n, entry in enumerate(entries, 1):
+            if self.cancelled:
+                return
+            try:
+                steamid, maf = validate_entry(self.source, entry)
+            except (IOError, ValueError, KeyError, TypeError, AttributeError, guard.SteamAuthenticatorError):
+                self.invalid += 1
+            else:
+                if steamid in seen:
+                    self.duplicates += 1
+                else:
+                    seen.add(steamid)
+                    self.valid.append((entry, steamid))
+            self.progress.emit(n, len(entries))
+
+
+def run_import(source, existing_steamids=(), parent=None):
+    # Validates the folder in a worker thread while a progress dialog keeps the UI responsive. Returns the finished
+    # worker, or None if the user cancelled.
+    worker = ImportWorker(source, existing_steamids)
+    progress = QtWidgets.QProgressDialog('Validating maFiles...', 'Cancel', 0, 0, parent)
+    progress.setWindowTitle('Import maFiles')
+    progress.setWindowModality(QtCore.Qt.WindowModal)
+    progress.setMinimumDuration(300)
+    worker.progress.connect(lambda n, total: (progress.setMaximum(total), progress.setValue(n)))
+    progress.canceled.connect(worker.cancel)
+    loop = QtCore.QEventLoop()
+    worker.finished.connect(loop.quit)
+    worker.start()
+    loop.exec_()
+    worker.wait()
+    progress.canceled.disconnect()
+    progress.close()
+    progress.deleteLater()
+    return None if worker.cancelled else worker
+
+
+def merge(worker, dest, manifest=None):
+    # Copies the validated maFiles into dest and appends them to manifest (or a new one based on the source
+    # manifest's settings), writing the manifest last. Returns the merged manifest.
+    if manifest is None:
+        manifest = dict(worker.source_manifest or {'periodic_checking': False, 'first_run': False,
+                                                   'periodic_checking_interval': 5,
+                                                   'periodic_checking_checkall': False,
+                                                   'auto_confirm_market_transactions': False,
+                                                   'auto_confirm_trades': False})
+        manifest.pop('selected_account', None)
+        manifest['encrypted'] = False
+        manifest['entries'] = []
+    os.makedirs(dest, exist_ok=True)
+    with FileHandler.locked(dest):
+        existing_files = set(os.listdir(dest))
+        for entry, steamid in sorted(worker.valid, key=lambda x: x[1]):
+            filename = os.path.basename(entry['filename'])
+            # On a clash fall back to <steamid>.maFile, then <steamid>-2.maFile and so on until a name is free
+            n = 1
+            while filename in existing_files:
+                filename = '{0}.maFile'.format(steamid) if n == 1 else '{0}-{1}.maFile'.format(steamid, n)
+                n += 1
+            shutil.copy2(os.path.join(worker.source, entry['filename']), os.path.join(dest, filename))
+            existing_files.add(filename)
+            manifest['entries'].append({'steamid': steamid, 'encryption_iv': None, 'encryption_salt': None,
+                                        'filename': filename})
+        FileHandler.write_json(os.path.join(dest, 'manifest.json'), manifest)
+    return manifest
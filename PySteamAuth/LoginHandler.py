@@ -0,0 +1,180 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import requests
+from PyQt5 import QtCore, QtWidgets
+from steam import webauth
+
+import Common
+
+try:
+    import keyring
+except ImportError:
+    keyring = None
+
+
+class RateLimiter(object):
+    # Token bucket shared by the login threads: at most burst logins at once, refilled at rate per second
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+def read_credentials(path):
+    # A JSON object of account name -> password; missing or unreadable files just mean no stored passwords
+    try:
+        with open(path) as f:
+            credentials = json.load(f)
+        return credentials if isinstance(credentials, dict) else {}
+    except (IOError, ValueError):
+        return {}
+
+
+def get_password(account_name, credentials):
+    # The system keyring (service "PySteamAuth") is preferred when the keyring package is installed
+    if keyring:
+        try:
+            password = keyring.get_password('PySteamAuth', account_name)
+            if password:
+                return password
+        except Exception:
+            pass
+    return credentials.get(account_name)
+
+
+def login(sa, password, limiter, retried=False):
+    # Returns (status, MobileWebAuth or None). status is 'ok', 'interactive' (captcha or email code needed),
+    # 'incorrect', 'twofactor' or 'error'. A rejected code is most likely one from the very end of its window, so the
+    # first attempt returns ('retry', time.monotonic() deadline) instead of waiting for the next code itself; the
+    # caller tries again with retried=True once the deadline has passed.
+    limiter.wait()
+    mwa = webauth.MobileWebAuth(sa.secrets['account_name'], password)
+    try:
+        mwa.login(twofactor_code=sa.get_code())
+        return 'ok', mwa
+    except (webauth.CaptchaRequired, webauth.EmailCodeRequired):
+        return 'interactive', None
+    except webauth.LoginIncorrect:
+        return 'incorrect', None
+    except webauth.TwoFactorCodeRequired:
+        if retried:
+            return 'twofactor', None
+        return 'retry', time.monotonic() + 30 - sa.get_time() % 30 + 1
+    except (webauth.HTTPError, requests.exceptions.RequestException, KeyError):
+        return 'error', None
+
+
+class BatchLoginWorker(QtCore.QThread):
+    progress = QtCore.pyqtSignal(int, int)
+
+    def __init__(self, accounts, concurrency=4, rate=0.5):
+        # accounts is a list of (SteamAuthenticator, password) pairs
+        super().__init__()
+        self.accounts = accounts
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.cancelled = False
+        self.results = []
+
+    def cancel(self):
+        self.cancelled = True
+
+    def login(self, sa, password, retried=False):
+        if self.cancelled:
+            return 'cancelled', None
+        return login(sa, password, self.limiter, retried)
+
+    def run(self):
+        # Logins waiting for the next 2FA code are resubmitted once it is out, so they don't hold a pool thread
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            pending = {pool.submit(self.login, sa, password): (sa, password) for sa, password in self.accounts}
+            retries = []
+            while pending or retries:
+                now = time.monotonic()
+                for due in [i for i in retries if i[0] <= now]:
+                    retries.remove(due)
+                    pending[pool.submit(self.login, due[1], due[2], True)] = due[1:]
+                delay = max(min(i[0] for i in retries) - now, 0) if retries else None
+                if not pending:
+                    time.sleep(delay)
+                    continue
+                for future in concurrent.futures.wait(pending, delay, concurrent.futures.FIRST_COMPLETED)[0]:
+                    sa, password = pending.pop(future)
+                    status, result = future.result()
+                    if status == 'retry':
+                        retries.append((result, sa, password))
+                        continue
+                    self.results.append((sa, status, result))
+                    self.progress.emit(len(self.results), len(self.accounts))
+
+
+def run_batch_login(accounts, concurrency=4, rate=0.5, parent=None):
+    # Same progress dialog handling as ImportHandler.run_import. Returns the finished worker; its results are
+    # (sa, status, mwa) tuples, and accounts that were not tried after a cancel have the status 'cancelled'.
+    worker = BatchLoginWorker(accounts, concurrency, rate)
+    progress = QtWidgets.QProgressDialog('Logging in...', 'Cancel', 0, len(accounts), parent)
+    progress.setWindowTitle('Log In All Accounts')
+    progress.setWindowModality(QtCore.Qt.WindowModal)
+    progress.setMinimumDuration(300)
+    worker.progress.connect(lambda n, total: progress.setValue(n))
+    progress.canceled.connect(worker.cancel)
+    loop = QtCore.QEventLoop()
+    worker.finished.connect(loop.quit)
+    worker.start()
+    loop.exec_()
+    worker.wait()
+    progress.canceled.disconnect()
+    progress.close()
+    progress.deleteLater()
+    return worker
+
+
+def load_settings(folder, config=None):
+    # From the manifest, eg. "batch_login": {"concurrency": 4, "rate": 0.5}; rate is logins per second. Passwords come
+    # from the system keyring. A plaintext credentials file would sit next to the maFiles, so anyone who can read
+    # the folder or a backup of it would get both the password and the 2FA secrets; it is only read with an explicit
+    # "plaintext_credentials": true (and "credentials": "credentials.json", relative to the maFiles folder).
+    config = config or {}
+    path = os.path.join(folder, config.get('credentials', 'credentials.json'))
+    if config.get('plaintext_credentials'):
+        credentials = read_credentials(path)
+    else:
+        credentials = {}
+        if os.path.isfile(path):
+            Common.notify('{0} is ignored: plaintext passwords are only read with "plaintext_credentials": true in '
+                          'the manifest\'s batch_login settings.'.format(os.path.basename(path)), 'Warning')
+    return credentials, config.get('concurrency', 4), config.get('rate', 0.5)
@@ -0,0 +1,211 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import http.server
+import os
+import socketserver
+import threading
+import time
+
+import Common
+
+
+class Counter(object):
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(i, '')) for i in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation), '# TYPE {0} counter'.format(self.name)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('{0}{{{1}}} {2}'.format(self.name, format_labels(self.labels, key), value))
+        return lines
+
+
+class Histogram(object):
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(i, '')) for i in self.labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[n] += 1
+            counts[-1] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation), '# TYPE {0} histogram'.format(self.name)]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                labels = format_labels(self.labels, key)
+                for bound, count in zip([str(i) for i in self.buckets] + ['+Inf'], counts):
+                    lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(self.name, labels, bound, count))
+                lines.append('{0}_sum{{{1}}} {2}'.format(self.name, labels, total))
+                lines.append('{0}_count{{{1}}} {2}'.format(self.name, labels, counts[-1]))
+        return lines
+
+
+def format_labels(names, values):
+    return ','.join('{0}="{1}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for k, v in zip(list(process_labels) + list(names), list(process_labels.values()) + list(values)))
+
+
+# Added to every series, eg. shard="2" in a sharded worker
+process_labels = {}
+
+
+steam_requests = Counter('pysteamauth_steam_requests_total', 'Steam requests by endpoint, account and outcome.',
+                         ['endpoint', 'account', 'outcome'])
+steam_request_seconds = Histogram('pysteamauth_steam_request_seconds',
+                                  'Steam request latency including retries, by endpoint, account and outcome.',
+                                  ['endpoint', 'account', 'outcome'])
+steam_request_retries = Counter('pysteamauth_steam_request_retries_total', 'Retried Steam request attempts.',
+                                ['endpoint'])
+confirmations = Counter('pysteamauth_confirmations_total', 'Confirmations fetched, accepted and denied.',
+                        ['account', 'action'])
+session_refreshes = Counter('pysteamauth_session_refreshes_total', 'Web session refreshes by outcome.',
+                            ['account', 'outcome'])
+feed_events = Counter('pysteamauth_feed_events_total', 'Change feed events by subscriber and outcome.',
+                      ['subscriber', 'outcome'])
+pending_probes = Counter('pysteamauth_pending_probes_total',
+                         'Pending-work probes by account and outcome; "skipped" saved a full confirmation fetch.',
+                         ['account', 'outcome'])
+registry = [steam_requests, steam_request_seconds, steam_request_retries, confirmations, session_refreshes,
+            feed_events, pending_probes]
+
+
+def account_label(sa):
+    secrets = getattr(sa, 'secrets', None) or {}
+    return secrets.get('account_name') or str(secrets.get('Session', {}).get('SteamID', ''))
+
+
+def render():
+    lines = []
+    for i in registry:
+        lines.extend(i.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+server = None
+writer = None
+
+
+def serve(port, host='127.0.0.1'):
+    # Serves /metrics from a daemon thread; only binds to localhost unless told otherwise
+    global server
+    if server:
+        return server
+    server = MetricsServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    return server
+
+
+def write_file(path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+def write_periodically(path, interval=15):
+    # For node_exporter's textfile collector or any runner without a port to spare
+    global writer
+    if writer:
+        return writer
+
+    def loop():
+        while True:
+            try:
+                write_file(path)
+            except OSError:
+                pass
+            time.sleep(interval)
+    writer = threading.Thread(target=loop, name='MetricsWriter', daemon=True)
+    writer.start()
+    return writer
+
+
+def reset():
+    # A forked shard worker starts with the supervisor's counts, and with its server and writer globals but not their
+    # threads
+    global server, writer
+    server = None
+    writer = None
+    for i in registry:
+        with i.lock:
+            i.values.clear()
+
+
+def configure(config, shard=None):
+    # From the manifest, eg. "metrics": {"port": 9108} or {"file": "/var/lib/node_exporter/psa.prom", "interval": 15}.
+    # Under --supervise the supervisor uses these as they are; shard worker N adds shard="N" to its series, listens on
+    # the port plus N + 1 and writes psa.shardN.prom next to the file.
+    if not config:
+        return
+    port = config.get('port')
+    path = config.get('file')
+    if shard is not None:
+        process_labels['shard'] = str(shard)
+        port = port and int(port) + shard + 1
+        if path:
+            root, ext = os.path.splitext(path)
+            path = '{0}.shard{1}{2}'.format(root, shard, ext)
+    if port:
+        try:
+            serve(int(port), config.get('host', '127.0.0.1'))
+        except OSError as e:
+            # Usually another instance or the supervisor already has the port; the file output still works
+            Common.notify('Could not listen on port {0}: {1}'.format(port, e), 'Metrics')
+    if path:
+        write_periodically(path, config.get('interval', 15))
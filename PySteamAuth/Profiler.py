@@ -0,0 +1,136 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import atexit
+import functools
+import inspect
+import sys
+import threading
+import time
+import traceback
+
+from PyQt5 import QtCore
+
+
+# Opt-in with --profile; all helpers are no-ops otherwise
+enabled = False
+stall_threshold = 0.25
+stats = {}
+stats_lock = threading.Lock()
+stalls = []
+
+
+def enable(threshold=None):
+    global enabled, stall_threshold
+    enabled = True
+    if threshold:
+        stall_threshold = threshold
+    atexit.register(dump_summary)
+
+
+def record(name, elapsed):
+    with stats_lock:
+        entry = stats.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+
+
+def max_args(func):
+    try:
+        params = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):
+        return None
+    if any(i.kind == i.VAR_POSITIONAL for i in params):
+        return None
+    return len([i for i in params if i.kind in (i.POSITIONAL_ONLY, i.POSITIONAL_OR_KEYWORD)])
+
+
+def slot(name, func=None):
+    # Times func under name. Usable as a decorator (slot('name')) or a wrapper (slot('name', func)). Extra signal
+    # arguments are dropped like PyQt does for plain callables, since the wrapper itself accepts any arguments.
+    if func is None:
+        return lambda f: slot(name, f)
+    if not enabled:
+        return func
+    n = max_args(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*(args if n is None else args[:n]), **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+    return wrapper
+
+
+class StallWatchdog(object):
+    # A main thread timer stamps a heartbeat; a daemon thread logs the main thread's stack when the heartbeat is older
+    # than the threshold. Nested event loops (modal dialogs) keep the heartbeat going, so they are not reported.
+    def __init__(self, parent, threshold):
+        self.threshold = threshold
+        self.main_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.reported = False
+        self.timer = QtCore.QTimer(parent)
+        self.timer.setInterval(int(threshold * 1000 / 4) or 1)
+        self.timer.timeout.connect(self.beat)
+        self.timer.start()
+        self.thread = threading.Thread(target=self.watch, name='StallWatchdog', daemon=True)
+        self.thread.start()
+
+    def beat(self):
+        now = time.monotonic()
+        if self.reported:
+            print('[profile] main thread unblocked after {0:.0f} ms'.format((now - self.last_beat) * 1000),
+                  file=sys.stderr)
+            self.reported = False
+        self.last_beat = now
+
+    def watch(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            blocked = time.monotonic() - self.last_beat
+            if blocked < self.threshold or self.reported:
+                continue
+            self.reported = True
+            frame = sys._current_frames().get(self.main_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else ''
+            stalls.append((blocked, stack))
+            print('[profile] main thread blocked for {0:.0f} ms:\n{1}'.format(blocked * 1000, stack), file=sys.stderr)
+
+
+watchdog = None
+
+
+def start_watchdog(parent):
+    global watchdog
+    if enabled and watchdog is None:
+        watchdog = StallWatchdog(parent, stall_threshold)
+
+
+def dump_summary():
+    with stats_lock:
+        rows = sorted(stats.items(), key=lambda x: x[1][1], reverse=True)
+    print('[profile] {0:<24}{1:>8}{2:>12}{3:>12}{4:>12}'.format('slot', 'calls', 'total ms', 'mean ms', 'max ms'),
+          file=sys.stderr)
+    for name, (count, total, longest) in rows:
+        print('[profile] {0:<24}{1:>8}{2:>12.1f}{3:>12.2f}{4:>12.1f}'.format(name, count, total * 1000,
+                                                                             total * 1000 / count, longest * 1000),
+              file=sys.stderr)
+    print('[profile] {0} main thread stall(s) over {1:.0f} ms'.format(len(stalls), stall_threshold * 1000),
+          file=sys.stderr)
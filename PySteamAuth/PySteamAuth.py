@@ -29,7 +29,18 @@ from PyQt5 import QtWidgets, QtGui, QtCore
 import PyUIs
 import ConfirmationHandler
 import AccountHandler
+import AccountStore
+import AuditLog
+import AutoAcceptHandler
+import ChangeFeed
 import Common
+import DialogHandler
+import FileHandler
+import Metrics
+import Profiler
+import RequestHandler
+# DashboardHandler, ImportHandler, LoginHandler and ShardHandler (which pulls in aiohttp) are only imported by the
+# actions that use them, to keep them out of startup
 
 
 if not(sys.version_info.major == 3 and sys.version_info.minor >= 6):
@@ -40,6 +51,13 @@ class Empty(object):
     pass
 
 
+# Handles for every account; see AccountStore for which authenticators stay loaded
+loaded_accounts = AccountStore.AccountStore()
+active_sa = None
+dashboard = None
+watcher = None
+
+
 def code_update(sa, code_box, code_bar):
     time = code_bar.value() - 1
     if time == 0:
@@ -49,13 +67,6 @@ def code_update(sa, code_box, code_bar):
     code_bar.setValue(time)
 
 
-def restart():
-    if getattr(sys, 'frozen', False):
-        os.execl(sys.executable, sys.executable)
-    else:
-        os.execl(sys.executable, sys.executable, os.path.abspath(__file__))
-
-
 def open_path(path):
     if sys.platform in ['windows', 'win32']:
         subprocess.Popen(['explorer', '/select', path])
@@ -65,12 +76,108 @@ def open_path(path):
         subprocess.Popen(["xdg-open", path])
 
 
-def save_mafiles(sa=None):
-    with open(os.path.join(mafiles_folder_path, 'manifest.json'), 'w') as manifest_file:
-        json.dump(manifest, manifest_file)
-    if sa:
-        with open(os.path.join(mafiles_folder_path, mafile_name), 'w') as mafile:
-            json.dump(sa.secrets, mafile)
+def save_mafiles(sa=None, keys=(), removed=None):
+    # Merges this process's changes into the files on disk, reading and writing under one lock so that entries and
+    # sessions saved by other processes in the meantime are kept. The manifest only takes the selected account and the
+    # removed entry; sa's maFile only takes the given top-level keys of its secrets, and the rest of sa.secrets is
+    # brought up to date with the file. sa must come from loaded_accounts; an unknown authenticator raises KeyError
+    # before anything is written.
+    global manifest, manifest_entry_index
+
+    filename = loaded_accounts.filename_of(sa) if sa else None
+    manifest_path = os.path.join(mafiles_folder_path, 'manifest.json')
+    with FileHandler.locked(mafiles_folder_path):
+        try:
+            merged = FileHandler.read_json(manifest_path)
+            merged['entries'] = [i for i in merged['entries'] if i['filename'] != removed]
+        except (IOError, ValueError, KeyError, TypeError):
+            merged = manifest
+        filenames = [i['filename'] for i in merged['entries']]
+        if mafile_name in filenames and len(filenames) > 1:
+            merged['selected_account'] = filenames.index(mafile_name)
+        else:
+            merged.pop('selected_account', None)
+        FileHandler.write_json(manifest_path, merged)
+        if filename:
+            path = os.path.join(mafiles_folder_path, filename)
+            try:
+                secrets = FileHandler.read_json(path)
+            except (IOError, ValueError):
+                secrets = None
+            if not isinstance(secrets, dict):
+                secrets = dict(sa.secrets)
+            for key in keys:
+                if key in sa.secrets:
+                    secrets[key] = sa.secrets[key]
+                else:
+                    secrets.pop(key, None)
+            FileHandler.write_json(path, secrets)
+            sa.secrets.update((k, v) for k, v in secrets.items() if k not in keys)
+    manifest = merged
+    if mafile_name in filenames:
+        manifest_entry_index = filenames.index(mafile_name)
+
+
+def reload_app():
+    code_timer.stop()
+    aa_job.configure(None, False, False)
+    main_window.hide()
+    app_load()
+
+
+def reload_manifest():
+    global manifest, manifest_entry_index
+
+    try:
+        with FileHandler.locked(mafiles_folder_path, False):
+            new_manifest = FileHandler.read_json(os.path.join(mafiles_folder_path, 'manifest.json'))
+        filenames = [i['filename'] for i in new_manifest['entries']]
+    except (IOError, ValueError, KeyError, TypeError):
+        return
+    manifest = new_manifest
+    RequestHandler.configure(manifest.get('network_policy'))
+    aa_job.details_filter = ConfirmationHandler.details_rule(manifest.get('auto_accept_rules'))
+    loaded_accounts.retain(filenames)
+    if mafile_name in filenames:
+        manifest_entry_index = filenames.index(mafile_name)
+        if len(filenames) > 1:
+            manifest['selected_account'] = manifest_entry_index
+    else:
+        manifest.pop('selected_account', None)
+        reload_app()
+
+
+def reload_mafile(filename):
+    if filename not in loaded_accounts.handles:
+        return
+    try:
+        maf = FileHandler.read_json(os.path.join(mafiles_folder_path, filename))
+        guard.SteamAuthenticator(secrets=maf).get_code(timestamp=0)
+    except (IOError, ValueError, KeyError, TypeError, AttributeError, guard.SteamAuthenticatorError):
+        return
+    sa = loaded_accounts.update(filename, maf)
+    if sa is not None and sa is active_sa:
+        main_window.setWindowTitle('PySteamAuth - ' + sa.secrets['account_name'])
+        main_ui.codeBox.setText(sa.get_code())
+        main_ui.codeBox.setAlignment(QtCore.Qt.AlignCenter)
+
+
+def mafile_removed(filename):
+    loaded_accounts.discard(filename)
+    if filename == mafile_name:
+        reload_app()
+
+
+def watch_mafiles():
+    global watcher
+
+    if watcher:
+        watcher.stop()
+        watcher.deleteLater()
+    watcher = FileHandler.MaFileWatcher(mafiles_folder_path, main_window)
+    watcher.manifest_changed.connect(Profiler.slot('reload_manifest', reload_manifest))
+    watcher.mafile_changed.connect(Profiler.slot('reload_mafile', reload_mafile))
+    watcher.mafile_removed.connect(Profiler.slot('mafile_removed', mafile_removed))
 
 
 def refresh_session_handler():
@@ -84,26 +191,28 @@ def backup_codes_popup(sa):
             return
         sa.backend = mwa
     try:
-        sa.create_emergency_codes()
+        AccountHandler.call_with_backend(sa, Common.run_in_background, sa.create_emergency_codes)
         endfunc = Empty()
         endfunc.endfunc = False
-        code_dialog = QtWidgets.QDialog()
-        code_ui = PyUIs.PhoneDialog.Ui_Dialog()
-        code_ui.setupUi(code_dialog)
-        code_ui.buttonBox.rejected.connect(lambda: setattr(endfunc, 'endfunc', True))
+        code_dialog = DialogHandler.get_dialog(PyUIs.PhoneDialog.Ui_Dialog)
+        code_ui = code_dialog.ui
+        code_dialog.bind(code_ui.buttonBox.rejected, lambda: setattr(endfunc, 'endfunc', True))
         code_dialog.exec_()
         if endfunc.endfunc:
             return
-        codes = sa.create_emergency_codes(code_ui.codeBox.text())
+        codes = Common.run_to_completion(sa.create_emergency_codes, code_ui.codeBox.text())
         codes = '\n'.join(codes)
+    except Common.Cancelled:
+        # Only the request for the SMS code can be cancelled
+        return
     except guard.SteamAuthenticatorError as e:
         Common.error_popup(str(e))
         return
     if len(codes) > 0:
-        bcodes_dialog = QtWidgets.QDialog()
-        bcodes_ui = PyUIs.BackupCodesCreatedDialog.Ui_Dialog()
-        bcodes_ui.setupUi(bcodes_dialog)
-        bcodes_ui.copyButton.clicked.connect(lambda: (bcodes_ui.codeBox.selectAll(), bcodes_ui.codeBox.copy()))
+        bcodes_dialog = DialogHandler.get_dialog(PyUIs.BackupCodesCreatedDialog.Ui_Dialog)
+        bcodes_ui = bcodes_dialog.ui
+        bcodes_dialog.bind(bcodes_ui.copyButton.clicked,
+                           lambda: (bcodes_ui.codeBox.selectAll(), bcodes_ui.codeBox.copy()))
         bcodes_ui.codeBox.setText(codes)
         bcodes_dialog.exec_()
     else:
@@ -118,15 +227,14 @@ def backup_codes_delete(sa):
         sa.backend = mwa
     endfunc = Empty()
     endfunc.endfunc = False
-    bcodes_dialog = QtWidgets.QDialog()
-    bcodes_ui = PyUIs.BackupCodesDeleteDialog.Ui_Dialog()
-    bcodes_ui.setupUi(bcodes_dialog)
-    bcodes_ui.buttonBox.rejected.connect(lambda: setattr(endfunc, 'endfunc', True))
+    bcodes_dialog = DialogHandler.get_dialog(PyUIs.BackupCodesDeleteDialog.Ui_Dialog)
+    bcodes_ui = bcodes_dialog.ui
+    bcodes_dialog.bind(bcodes_ui.buttonBox.rejected, lambda: setattr(endfunc, 'endfunc', True))
     bcodes_dialog.exec_()
     if endfunc.endfunc:
         return
     try:
-        sa.destroy_emergency_codes()
+        AccountHandler.call_with_backend(sa, Common.run_to_completion, sa.destroy_emergency_codes)
     except guard.SteamAuthenticatorError as e:
         Common.error_popup(str(e))
 
@@ -142,7 +250,7 @@ def test_mafiles(path, entry=False):
             with open(os.path.join(path, test_manifest['entries'][entry]['filename'])) as maf_file:
                 maf = json.loads(maf_file.read())
             sa = guard.SteamAuthenticator(secrets=maf)
-            sa.get_code()
+            sa.get_code(timestamp=0)
         except (IOError, json.decoder.JSONDecodeError, guard.SteamAuthenticatorError):
             manifest_file.close()
             return False
@@ -155,7 +263,7 @@ def test_mafiles(path, entry=False):
                 with open(os.path.join(path, i['filename'])) as maf_file:
                     maf = json.loads(maf_file.read())
                 sa = guard.SteamAuthenticator(secrets=maf)
-                sa.get_code()
+                sa.get_code(timestamp=0)
                 valid_entries.append(i)
             except (IOError, json.decoder.JSONDecodeError, guard.SteamAuthenticatorError):
                 continue
@@ -163,29 +271,6 @@ def test_mafiles(path, entry=False):
         return valid_entries
 
 
-def set_autoaccept(timer, sa, trades, markets):
-    if trades or markets:
-        timer.timeout.connect(lambda: accept_all(sa, trades, markets, False), QtCore.Qt.QueuedConnection)
-        timer.start()
-    else:
-        timer.stop()
-
-
-def accept_all(sa, trades=True, markets=True, others=True):
-    AccountHandler.refresh_session(sa)
-    confs = ConfirmationHandler.fetch_confirmations(sa)
-    for i in range(len(confs)):
-        if (not trades) and (confs[i].type == 2):
-            del confs[i]
-        if (not markets) and (confs[i].type == 3):
-            del confs[i]
-        if (not others) and not (confs[i].type in [2, 3]):
-            del confs[i]
-    if len(confs) == 0:
-        return True
-    return ConfirmationHandler.confirm_multi(sa, confs, 'allow')
-
-
 def open_conf_dialog(sa):
     if not AccountHandler.refresh_session(sa):
         return
@@ -199,8 +284,11 @@ def open_conf_dialog(sa):
     conf_dialog = QtWidgets.QDialog()
     conf_ui = PyUIs.ConfirmationDialog.Ui_Dialog()
     conf_ui.setupUi(conf_dialog)
+    Common.load_resources()
     default_pixmap = QtGui.QPixmap(':/icons/confirmation_placeholder.png')
+    details = ConfirmationHandler.details_cache(sa)
 
+    @Profiler.slot('load_info')
     def load_info():
         if len(info.confs) == 0:
             conf_dialog.hide()
@@ -209,38 +297,58 @@ def open_conf_dialog(sa):
             Common.error_popup('Nothing to confirm.', '  ')
             main_ui.confListButton.setText('Confirmations')
             return
-        while True:
-            try:
-                conf = info.confs[info.index]
-                break
-            except IndexError:
-                info.index -= 1
+        info.index = min(info.index, len(info.confs) - 1)
+        conf = info.confs.at(info.index)
         conf_ui.titleLabel.setText(conf.description)
         conf_ui.infoLabel.setText('{0}\nTime: {1}\nID: {2}\nType: {3}'
                                   .format(conf.sub_description, conf.time, conf.id, conf.type_str))
         if conf.icon_url:
             pixmap = QtGui.QPixmap()
-            pixmap.loadFromData(requests.get(conf.icon_url).content)
+            try:
+                pixmap.loadFromData(RequestHandler.request('icon', 'GET', conf.icon_url).content)
+            except requests.exceptions.RequestException:
+                pixmap = default_pixmap
             conf_ui.iconLabel.setPixmap(pixmap)
         else:
             conf_ui.iconLabel.setPixmap(default_pixmap)
         conf_ui.backButton.setDisabled(info.index == 0)
         conf_ui.nextButton.setDisabled(info.index == (len(info.confs) - 1))
+        load_details()
 
+    def load_details(conf_id=None):
+        if len(info.confs) == 0:
+            return
+        conf = info.confs.at(info.index)
+        if conf_id is not None and conf_id != conf.id:
+            return
+        if conf.details is not None:
+            conf_ui.detailsBox.setPlainText(conf.details)
+        elif details.is_pending(conf.id):
+            conf_ui.detailsBox.setPlainText('Loading details...')
+        else:
+            conf_ui.detailsBox.setPlainText('Details unavailable.')
+
+    @Profiler.slot('accept')
     def accept():
         AccountHandler.refresh_session(sa)
-        if not info.confs[info.index].accept(sa):
+        conf = info.confs.at(info.index)
+        if conf.accept(sa):
+            info.confs.discard(conf)
+        else:
             Common.error_popup('Failed to accept confirmation.')
-        info.confs = ConfirmationHandler.fetch_confirmations(sa)
         load_info()
 
+    @Profiler.slot('deny')
     def deny():
         AccountHandler.refresh_session(sa)
-        if not info.confs[info.index].deny(sa):
-            Common.error_popup('Failed to accept confirmation.')
-        info.confs = ConfirmationHandler.fetch_confirmations(sa)
+        conf = info.confs.at(info.index)
+        if conf.deny(sa):
+            info.confs.discard(conf)
+        else:
+            Common.error_popup('Failed to deny confirmation.')
         load_info()
 
+    @Profiler.slot('refresh_confs')
     def refresh_confs():
         AccountHandler.refresh_session(sa)
         info.confs = ConfirmationHandler.fetch_confirmations(sa)
@@ -255,7 +363,9 @@ def open_conf_dialog(sa):
                                                                         else info.index)), load_info()))
     conf_ui.acceptButton.clicked.connect(accept)
     conf_ui.denyButton.clicked.connect(deny)
+    details.ready.connect(load_details)
     conf_dialog.exec_()
+    details.ready.disconnect(load_details)
 
 
 def add_authenticator():
@@ -265,39 +375,40 @@ def add_authenticator():
     if not mwa:
         return
     sa = guard.SteamAuthenticator(backend=mwa)
-    if not sa.has_phone_number():
-        code_dialog = QtWidgets.QDialog()
-        code_ui = PyUIs.PhoneDialog.Ui_Dialog()
-        code_ui.setupUi(code_dialog)
-        code_ui.buttonBox.rejected.connect(lambda: setattr(endfunc, 'endfunc', True))
+    try:
+        has_phone_number = Common.run_in_background(sa.has_phone_number)
+    except Common.Cancelled:
+        return
+    if not has_phone_number:
+        code_dialog = DialogHandler.get_dialog(PyUIs.PhoneDialog.Ui_Dialog)
+        code_ui = code_dialog.ui
+        code_dialog.bind(code_ui.buttonBox.rejected, lambda: setattr(endfunc, 'endfunc', True))
         code_dialog.setWindowTitle('Phone number')
         code_ui.actionBox.setText('This account is missing a phone number. Type yours below to add it.\n'
                                   'Eg. +1 123-456-7890')
         code_dialog.exec_()
         if endfunc.endfunc:
             return
-        if sa.add_phone_number(code_ui.codeBox.text().replace('-', '')):
-            code_dialog = QtWidgets.QDialog()
-            code_ui = PyUIs.PhoneDialog.Ui_Dialog()
-            code_ui.setupUi(code_dialog)
-            code_ui.buttonBox.rejected.connect(lambda: setattr(endfunc, 'endfunc', True))
+        if Common.run_to_completion(sa.add_phone_number, code_ui.codeBox.text().replace('-', '')):
+            code_dialog = DialogHandler.get_dialog(PyUIs.PhoneDialog.Ui_Dialog)
+            code_ui = code_dialog.ui
+            code_dialog.bind(code_ui.buttonBox.rejected, lambda: setattr(endfunc, 'endfunc', True))
             code_dialog.exec_()
             if endfunc.endfunc:
                 return
-            if not sa.confirm_phone_number(code_ui.codeBox.text()):
+            if not Common.run_to_completion(sa.confirm_phone_number, code_ui.codeBox.text()):
                 Common.error_popup('Failed to confirm phone number')
                 return
         else:
             Common.error_popup('Failed to add phone number.')
             return
     try:
-        sa.add()
+        Common.run_to_completion(sa.add)
     except guard.SteamAuthenticatorError as e:
         if 'DuplicateRequest' in str(e):
-            code_dialog = QtWidgets.QDialog()
-            code_ui = PyUIs.PhoneDialog.Ui_Dialog()
-            code_ui.setupUi(code_dialog)
-            code_ui.buttonBox.rejected.connect(lambda: setattr(endfunc, 'endfunc', True))
+            code_dialog = DialogHandler.get_dialog(PyUIs.PhoneDialog.Ui_Dialog)
+            code_ui = code_dialog.ui
+            code_dialog.bind(code_ui.buttonBox.rejected, lambda: setattr(endfunc, 'endfunc', True))
             code_dialog.setWindowTitle('Remove old authenticator')
             code_ui.actionBox.setText('There is already an authenticator associated with this account.'
                                       ' Enter its revocation code to remove it.')
@@ -307,8 +418,8 @@ def add_authenticator():
             sa.secrets = {'revocation_code': code_ui.codeBox.text()}
             sa.revocation_code = code_ui.codeBox.text()
             try:
-                sa.remove()
-                sa.add()
+                Common.run_to_completion(sa.remove)
+                Common.run_to_completion(sa.add)
             except guard.SteamAuthenticatorError as e:
                 Common.error_popup(str(e))
                 return
@@ -323,26 +434,26 @@ def add_authenticator():
         else:
             shutil.rmtree(mafiles_folder_path)
     os.mkdir(mafiles_folder_path)
-    with open(os.path.join(mafiles_folder_path, mwa.steam_id + '.maFile'), 'w') as maf:
-        maf.write(json.dumps(sa.secrets))
-    with open(os.path.join(mafiles_folder_path, 'manifest.json'), 'w') as manifest_file:
-        manifest_file.write(json.dumps(
-            {'periodic_checking': False, 'first_run': False, 'encrypted': False, 'periodic_checking_interval': 5,
-             'periodic_checking_checkall': False, 'auto_confirm_market_transactions': False,
-             'entries': [{'steamid': mwa.steam_id, 'encryption_iv': None, 'encryption_salt': None,
-                         'filename': mwa.steam_id + '.maFile'}], 'auto_confirm_trades': False}))
+    # The new account isn't in loaded_accounts yet, so this can't go through save_mafiles; the maFile is written
+    # before the manifest that lists it
+    with FileHandler.locked(mafiles_folder_path):
+        FileHandler.write_json(os.path.join(mafiles_folder_path, mwa.steam_id + '.maFile'), sa.secrets)
+        FileHandler.write_json(os.path.join(mafiles_folder_path, 'manifest.json'), {
+            'periodic_checking': False, 'first_run': False, 'encrypted': False, 'periodic_checking_interval': 5,
+            'periodic_checking_checkall': False, 'auto_confirm_market_transactions': False,
+            'entries': [{'steamid': mwa.steam_id, 'encryption_iv': None, 'encryption_salt': None,
+                         'filename': mwa.steam_id + '.maFile'}], 'auto_confirm_trades': False})
     Common.error_popup('This is your revocation code. Write it down physically and keep it. You will need it in case'
                        ' you lose your authenticator.', sa.secrets['revocation_code'])
-    code_dialog = QtWidgets.QDialog()
-    code_ui = PyUIs.PhoneDialog.Ui_Dialog()
-    code_ui.setupUi(code_dialog)
-    code_ui.buttonBox.rejected.connect(lambda: setattr(endfunc, 'endfunc', True))
+    code_dialog = DialogHandler.get_dialog(PyUIs.PhoneDialog.Ui_Dialog)
+    code_ui = code_dialog.ui
+    code_dialog.bind(code_ui.buttonBox.rejected, lambda: setattr(endfunc, 'endfunc', True))
     while True:
         code_dialog.exec_()
         if endfunc.endfunc:
             return
         try:
-            sa.finalize(code_ui.codeBox.text())
+            Common.run_to_completion(sa.finalize, code_ui.codeBox.text())
             break
         except guard.SteamAuthenticatorError as e:
             code_ui.msgBox.setText(str(e))
@@ -356,61 +467,107 @@ def remove_authenticator(sa):
         sa.backend = mwa
     endfunc = Empty()
     endfunc.endfunc = False
-    code_dialog = QtWidgets.QDialog()
-    code_ui = PyUIs.PhoneDialog.Ui_Dialog()
-    code_ui.setupUi(code_dialog)
-    code_ui.buttonBox.rejected.connect(lambda: setattr(endfunc, 'endfunc', True))
+    code_dialog = DialogHandler.get_dialog(PyUIs.PhoneDialog.Ui_Dialog)
+    code_ui = code_dialog.ui
+    code_dialog.bind(code_ui.buttonBox.rejected, lambda: setattr(endfunc, 'endfunc', True))
     code_dialog.setWindowTitle('Remove authenticator')
     code_ui.actionBox.setText('Type \'yes\' into the box below to remove your\nauthenticator.')
     code_ui.msgBox.setText('Note that you will receive a 15-day\ntrade hold upon deactivating your authenticator.')
     for i in code_ui.buttonBox.buttons():
         if code_ui.buttonBox.buttonRole(i) == QtWidgets.QDialogButtonBox.AcceptRole:
             i.setEnabled(False)
-    code_ui.codeBox.textChanged.connect(lambda x: [(b.setEnabled(x.lower() == 'yes')
-                                                    if code_ui.buttonBox.buttonRole(b) ==
-                                                    QtWidgets.QDialogButtonBox.AcceptRole else None)
-                                                   for b in code_ui.buttonBox.buttons()])
+    code_dialog.bind(code_ui.codeBox.textChanged, lambda x: [(b.setEnabled(x.lower() == 'yes')
+                                                              if code_ui.buttonBox.buttonRole(b) ==
+                                                              QtWidgets.QDialogButtonBox.AcceptRole else None)
+                                                             for b in code_ui.buttonBox.buttons()])
     code_dialog.exec_()
     if endfunc.endfunc:
         return
     try:
-        sa.remove()
+        AccountHandler.call_with_backend(sa, Common.run_to_completion, sa.remove)
     except guard.SteamAuthenticatorError as e:
         Common.error_popup(str(e))
         return
     os.remove(os.path.join(mafiles_folder_path, mafile_name))
+    loaded_accounts.discard(mafile_name)
     del manifest['entries'][manifest_entry_index]
-    save_mafiles()
-    restart()
+    manifest.pop('selected_account', None)
+    save_mafiles(removed=mafile_name)
+    reload_app()
 
 
 def copy_mafiles():
+    global manifest
+    import ImportHandler
+
     while True:
         file_dialog = QtWidgets.QFileDialog()
         f = str(file_dialog.getExistingDirectory(caption='Select your maFiles folder.'))
         if f == '':
             break
-        if not test_mafiles(f):
+        if os.path.abspath(f) == os.path.abspath(mafiles_folder_path):
+            Common.error_popup('The selected folder is already the current maFiles folder.')
+            continue
+        existing_manifest = ImportHandler.read_manifest(mafiles_folder_path)
+        result = ImportHandler.run_import(f, [i['steamid'] for i in existing_manifest['entries']]
+                                          if existing_manifest else [], main_window)
+        if not result:
+            break
+        if not (result.valid or result.duplicates):
             Common.error_popup('The selected folder does not contain valid maFiles.')
             continue
-        if os.path.isdir(mafiles_folder_path):
-            if any('maFile' in x for x in os.listdir(mafiles_folder_path)) or 'manifest.json'\
-                    in os.listdir(mafiles_folder_path):
-                Common.error_popup('The maFiles folder at {} is not empty.\nPlease remove it.'
-                                   .format(mafiles_folder_path))
-                continue
-            else:
-                shutil.rmtree(mafiles_folder_path)
-        shutil.copytree(f, mafiles_folder_path)
+        manifest = ImportHandler.merge(result, mafiles_folder_path, existing_manifest)
+        Common.error_popup('Imported {0} account(s).\n{1} already present, {2} invalid.'
+                           .format(len(result.valid), result.duplicates, result.invalid), 'Import complete')
         break
 
 
+def login_all():
+    # Logs every account in with its stored password and its own 2FA code; only accounts Steam asks for a captcha or
+    # email code are prompted for afterwards
+    import LoginHandler
+
+    credentials, concurrency, rate = LoginHandler.load_settings(mafiles_folder_path, manifest.get('batch_login'))
+    accounts = []
+    missing = 0
+    for index in range(len(manifest['entries'])):
+        try:
+            sa = load_account(index)
+        except (IOError, ValueError, KeyError):
+            continue
+        password = LoginHandler.get_password(sa.secrets['account_name'], credentials)
+        if password:
+            accounts.append((sa, password))
+        else:
+            missing += 1
+    if not accounts:
+        Common.error_popup('No stored passwords found. Add them to the system keyring (service "PySteamAuth").')
+        return
+    worker = LoginHandler.run_batch_login(accounts, concurrency, rate, main_window)
+    counts = {}
+    for sa, status, mwa in worker.results:
+        if status == 'ok':
+            AccountHandler.store_session(sa, mwa)
+        elif status == 'interactive':
+            if AccountHandler.full_refresh(sa):
+                status = 'ok'
+        counts[status] = counts.get(status, 0) + 1
+    Common.error_popup('Logged in {0} of {1} account(s).\n{2} wrong password, {3} 2FA failure, {4} error, '
+                       '{5} skipped, {6} without a stored password.'
+                       .format(counts.get('ok', 0), len(accounts) + missing, counts.get('incorrect', 0),
+                               counts.get('twofactor', 0), counts.get('error', 0),
+                               counts.get('interactive', 0) + counts.get('cancelled', 0), missing), 'Batch login')
+
+
 def app_load():
     global mafiles_folder_path, mafile_name, manifest_entry_index, manifest
 
     base_path = os.path.dirname(os.path.abspath(sys.executable)) if getattr(sys, 'frozen', False)\
         else os.path.dirname(os.path.abspath(__file__))
-    if test_mafiles(os.path.join(base_path, 'maFiles')):
+    mafiles_options = [i.split('=', 1)[1] for i in sys.argv if i.startswith('--mafiles=')]
+    if mafiles_options:
+        mafiles_folder_path = os.path.abspath(mafiles_options[-1])
+    elif test_mafiles(os.path.join(base_path, 'maFiles')):
         mafiles_folder_path = os.path.join(base_path, 'maFiles')
     elif test_mafiles(os.path.expanduser(os.path.join('~', '.maFiles'))) and '--dbg' not in sys.argv:
         mafiles_folder_path = os.path.expanduser(os.path.join('~', '.maFiles'))
@@ -421,42 +578,22 @@ def app_load():
         try:
             with open(os.path.join(mafiles_folder_path, 'manifest.json')) as manifest_file:
                 manifest = json.loads(manifest_file.read())  # TODO add encryption support
+            RequestHandler.configure(manifest.get('network_policy'))
             valid_entries = test_mafiles(mafiles_folder_path)
             if len(valid_entries) == 0:
                 raise ValueError('No valid Manifest Entries found!')
+            loaded_accounts.configure(mafiles_folder_path, manifest.get('account_cache'))
+            AuditLog.configure(mafiles_folder_path, manifest.get('audit_log'))
+            ConfirmationHandler.configure_probe(manifest.get('pending_probe'))
             manifest_entry_index = 0
             if len(manifest['entries']) > 1:
                 if ('selected_account' in manifest) and manifest['selected_account'] < len(manifest['entries']):
                     manifest_entry_index = manifest['selected_account']
                 else:
-                    ac_dialog = QtWidgets.QDialog()
-                    ac_ui = PyUIs.AccountChooserDialog.Ui_Dialog()
-                    ac_ui.setupUi(ac_dialog)
-                    for i in valid_entries:
-                        try:
-                            entry = [None, str(i['steamid']), i['filename']]
-                            with open(os.path.join(mafiles_folder_path, i['filename'])) as ma_file:
-                                entry[0] = json.load(ma_file)['account_name']
-                            ac_ui.accountSelectList.addTopLevelItem(QtWidgets.QTreeWidgetItem(entry))
-                        except (json.JSONDecodeError, IOError):
-                            continue
-                    # noinspection PyUnresolvedReferences
-                    ac_dialog.rejected.connect(sys.exit)
-                    ac_ui.accountSelectList.itemSelectionChanged.connect(
-                        lambda: ac_ui.buttonBox.setDisabled(len(ac_ui.accountSelectList.selectedItems()) != 1))
-                    ac_dialog.exec_()
-                    manifest_entry_index = ac_ui.accountSelectList.selectedIndexes()[0].row()
-                    manifest['selected_account'] = manifest_entry_index
-            mafile_name = manifest['entries'][manifest_entry_index]['filename']
-            with open(os.path.join(mafiles_folder_path, mafile_name), 'r+') as ma_file:
-                maf = json.load(ma_file)
-                if 'device_id' not in maf:
-                    maf['device_id'] = guard.generate_device_id(maf['steamid'])
-                    ma_file.seek(0)
-                    ma_file.write(json.dumps(maf))
-                    ma_file.truncate()
-            if not test_mafiles(mafiles_folder_path, manifest_entry_index):
-                raise IOError()
+                    manifest_entry_index = choose_account(valid_entries)
+                    if manifest_entry_index is None:
+                        sys.exit()
+            load_account(manifest_entry_index)
             break
         except (IOError, ValueError, TypeError, IndexError, KeyError) as e:
             if os.path.isdir(mafiles_folder_path):
@@ -470,60 +607,191 @@ def app_load():
             setup_ui.importButton.clicked.connect(lambda: (copy_mafiles(), setup_dialog.accept()))
             setup_ui.quitButton.clicked.connect(sys.exit)
             setup_dialog.exec_()
+    AccountHandler.save_secrets = save_mafiles
+    Metrics.configure(manifest.get('metrics'))
+    ChangeFeed.configure(manifest.get('change_feed'))
+    aa_job.details_filter = ConfirmationHandler.details_rule(manifest.get('auto_accept_rules'))
+    main_ui.tradeCheckBox.setChecked(manifest['auto_confirm_trades'])
+    main_ui.marketCheckBox.setChecked(manifest['auto_confirm_market_transactions'])
+    activate_account(manifest_entry_index)
+    watch_mafiles()
+
+    main_window.show()
+    main_window.raise_()
+
+
+def choose_account(valid_entries):
+    ac_dialog = QtWidgets.QDialog()
+    ac_ui = PyUIs.AccountChooserDialog.Ui_Dialog()
+    ac_ui.setupUi(ac_dialog)
+    for i in valid_entries:
+        try:
+            entry = [loaded_accounts.handle(i['filename']).account_name, str(i['steamid']), i['filename']]
+            ac_ui.accountSelectList.addTopLevelItem(QtWidgets.QTreeWidgetItem(entry))
+        except (IOError, ValueError, KeyError):
+            continue
+    ac_ui.accountSelectList.itemSelectionChanged.connect(
+        lambda: ac_ui.buttonBox.setDisabled(len(ac_ui.accountSelectList.selectedItems()) != 1))
+    if not ac_dialog.exec_() or len(ac_ui.accountSelectList.selectedItems()) != 1:
+        return None
+    filename = ac_ui.accountSelectList.selectedItems()[0].text(2)
+    return [i['filename'] for i in manifest['entries']].index(filename)
+
+
+def load_account(index):
+    # Recently used authenticators (and their restored web sessions) stay cached by filename so switching back is
+    # instant
+    return loaded_accounts.load(manifest['entries'][index]['filename'], lambda: read_account(index))
+
+
+def read_account(index):
+    filename = manifest['entries'][index]['filename']
+    maf = FileHandler.read_json(os.path.join(mafiles_folder_path, filename))
+    if 'device_id' not in maf:
+        maf['device_id'] = guard.generate_device_id(maf['steamid'])
+        with FileHandler.locked(mafiles_folder_path):
+            FileHandler.write_json(os.path.join(mafiles_folder_path, filename), maf)
+    if not test_mafiles(mafiles_folder_path, index):
+        raise IOError()
     sa = guard.SteamAuthenticator(maf)
+    sa.backend = AccountHandler.restore_web_session(sa)
+    return sa
+
+
+def activate_account(index):
+    global mafile_name, manifest_entry_index, active_sa
+
+    sa = load_account(index)
+    manifest_entry_index = index
+    mafile_name = manifest['entries'][index]['filename']
+    loaded_accounts.pin(mafile_name)
+    if len(manifest['entries']) > 1:
+        manifest['selected_account'] = index
+    active_sa = sa
     main_window.setWindowTitle('PySteamAuth - ' + sa.secrets['account_name'])
     main_ui.codeBox.setText(sa.get_code())
     main_ui.codeBox.setAlignment(QtCore.Qt.AlignCenter)
+    main_ui.codeTimeBar.setValue(30 - (sa.get_time() % 30))
+    code_timer.start()
+    aa_job.configure(sa, main_ui.tradeCheckBox.isChecked(), main_ui.marketCheckBox.isChecked())
+    save_mafiles()
+
+
+def switch_account():
+    index = choose_account(test_mafiles(mafiles_folder_path))
+    if index is not None and index != manifest_entry_index:
+        activate_account(index)
+
+
+def open_dashboard():
+    global dashboard
+    import DashboardHandler
+
+    accounts = []
+    for i in manifest['entries']:
+        try:
+            handle = loaded_accounts.handle(i['filename'])
+            accounts.append((handle.account_name, str(i['steamid']), handle.shared_secret))
+        except (IOError, ValueError, KeyError):
+            continue
+    if dashboard:
+        dashboard.dialog.close()
+        dashboard.dialog.deleteLater()
+    active_sa.get_time()
+    dashboard = DashboardHandler.Dashboard(accounts, active_sa.steam_time_offset or 0, main_window)
+    dashboard.show()
+
+
+def setup_main_window():
+    global code_timer, aa_job
+
+    # Every handler goes through active_sa so that the connections survive account switches
     main_ui.copyButton.clicked.connect(lambda: (main_ui.codeBox.selectAll(), main_ui.codeBox.copy()))
     main_ui.codeTimeBar.setTextVisible(False)
     main_ui.codeTimeBar.valueChanged.connect(main_ui.codeTimeBar.repaint)
-    main_ui.tradeCheckBox.setChecked(manifest['auto_confirm_trades'])
-    main_ui.marketCheckBox.setChecked(manifest['auto_confirm_market_transactions'])
-    main_ui.confAllButton.clicked.connect(lambda: accept_all(sa))
-    main_ui.confListButton.clicked.connect(lambda: open_conf_dialog(sa))
-    main_ui.removeButton.clicked.connect(lambda: remove_authenticator(sa))
-    main_ui.createBCodesButton.clicked.connect(lambda: backup_codes_popup(sa))
-    main_ui.removeBCodesButton.clicked.connect(lambda: backup_codes_delete(sa))
+    main_ui.confAllButton.clicked.connect(Profiler.slot('accept_all', lambda: aa_job.accept_all()))
+    main_ui.confListButton.clicked.connect(Profiler.slot('open_conf_dialog', lambda: open_conf_dialog(active_sa)))
+    main_ui.removeButton.clicked.connect(lambda: remove_authenticator(active_sa))
+    main_ui.createBCodesButton.clicked.connect(lambda: backup_codes_popup(active_sa))
+    main_ui.removeBCodesButton.clicked.connect(lambda: backup_codes_delete(active_sa))
     main_ui.actionOpen_Current_maFile.triggered.connect(lambda c: open_path(os.path.join(mafiles_folder_path,
                                                                                          mafile_name)))
-    main_ui.actionSwitch.triggered.connect(lambda c: (manifest.pop('selected_account'), save_mafiles(sa),
-                                                      restart()))
+    main_ui.actionSwitch.triggered.connect(lambda c: switch_account())
+    main_ui.actionDashboard.triggered.connect(Profiler.slot('open_dashboard', lambda c: open_dashboard()))
+    main_ui.actionImport.triggered.connect(lambda c: copy_mafiles())
+    main_ui.actionLoginAll.triggered.connect(lambda c: login_all())
 
     code_timer = QtCore.QTimer(main_window)
     code_timer.setInterval(1000)
-    code_timer.timeout.connect(lambda: code_update(sa, main_ui.codeBox, main_ui.codeTimeBar))
-    main_ui.codeTimeBar.setValue(30 - (sa.get_time() % 30))
-    code_timer.start()
+    code_timer.timeout.connect(Profiler.slot('code_update',
+                                             lambda: code_update(active_sa, main_ui.codeBox, main_ui.codeTimeBar)))
 
     aa_timer = QtCore.QTimer(main_window)
     aa_timer.setInterval(5000)
-    set_autoaccept(aa_timer, sa, main_ui.tradeCheckBox.isChecked(), main_ui.marketCheckBox.isChecked())
-    main_ui.tradeCheckBox.stateChanged.connect(lambda: set_autoaccept(aa_timer, sa, main_ui.tradeCheckBox.isChecked(),
-                                                                      main_ui.marketCheckBox.isChecked()))
-    main_ui.marketCheckBox.stateChanged.connect(lambda: set_autoaccept(aa_timer, sa, main_ui.tradeCheckBox.isChecked(),
-                                                                       main_ui.marketCheckBox.isChecked()))
+    aa_job = AutoAcceptHandler.AutoAcceptJob(aa_timer)
+    main_ui.tradeCheckBox.stateChanged.connect(lambda: aa_job.configure(active_sa, main_ui.tradeCheckBox.isChecked(),
+                                                                        main_ui.marketCheckBox.isChecked()))
+    main_ui.marketCheckBox.stateChanged.connect(lambda: aa_job.configure(active_sa,
+                                                                         main_ui.tradeCheckBox.isChecked(),
+                                                                         main_ui.marketCheckBox.isChecked()))
+
+
+class FirstPaintFilter(QtCore.QObject):
+    # Calls callback once, after the first paint of the widget it is installed on
+    def __init__(self, callback):
+        super().__init__()
+        self.callback = callback
+
+    def eventFilter(self, obj, event):
+        if event.type() == QtCore.QEvent.Paint:
+            obj.removeEventFilter(self)
+            QtCore.QTimer.singleShot(0, self.callback)
+        return False
 
-    main_window.show()
-    main_window.raise_()
 
-    save_mafiles(sa)
+def bench_startup_exit():
+    # Read by make.py bench-startup, which times the process from launch until this line appears
+    try:
+        import resource
+        rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            rss_kb //= 1024
+    except ImportError:
+        rss_kb = -1
+    print('BENCH-STARTUP', rss_kb, flush=True)
+    app.quit()
 
 
 def main(argv):  # TODO debug menubar actions
     global app, main_window, main_ui
 
     sys.argv = argv
+    if '--supervise' in argv:
+        import ShardHandler
+        ShardHandler.main(argv)
+        return
+    if '--profile' in argv:
+        Profiler.enable()
 
     signal.signal(signal.SIGINT, lambda x, y: app.exit(0))
     signal.signal(signal.SIGTERM, lambda x, y: app.exit(0))
 
     app = QtWidgets.QApplication(argv)
+    Profiler.start_watchdog(app)
     if '--test' in argv:
         sys.exit()
         # QtCore.QTimer.singleShot(3000, app.quit)
     main_window = QtWidgets.QMainWindow()
     main_ui = PyUIs.MainWindow.Ui_MainWindow()
     main_ui.setupUi(main_window)
+    Common.notification_center().attach(main_ui.statusbar)
+    setup_main_window()
+    if '--bench-startup' in argv:
+        # The normal start, usually against make.py's --mafiles fixture, timed until the main window is first painted.
+        # Steam's time sync is left out so that network latency doesn't count as a startup regression.
+        guard.get_time_offset = lambda: 0
+        first_paint = FirstPaintFilter(bench_startup_exit)
+        main_window.installEventFilter(first_paint)
     QtCore.QTimer.singleShot(0, app_load)
     app.exec_()
 
@@ -0,0 +1,182 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import random
+import threading
+import time
+
+import requests
+
+import Metrics
+
+
+# Overridable from the manifest, eg.
+# "network_policy": {"default": {"read_timeout": 20}, "mobileconf/conf": {"retries": 4}}
+DEFAULT_POLICY = {
+    'connect_timeout': 5,
+    'read_timeout': 15,
+    'retries': 2,
+    'backoff': 0.5,
+    'backoff_max': 4,
+    'failure_threshold': 5,
+    'recovery_time': 30
+}
+
+policies = {}
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+class CircuitBreaker(object):
+    # Closed until failure_threshold consecutive failures, then open (fail fast) for recovery_time seconds, after
+    # which a single probe request is let through. The probe's outcome closes or re-opens the circuit.
+    def __init__(self, failure_threshold, recovery_time):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.recovery_time:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def attempt(self):
+        return BreakerAttempt(self)
+
+
+class BreakerAttempt(object):
+    # One request that CircuitBreaker.allow let through, used as a context manager around it. Leaving the block
+    # without success() or failure() (ie. on any other exception) records a failure, so that a half-open probe is
+    # always settled.
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.settled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.settled:
+            self.failure()
+        return False
+
+    def success(self):
+        self.settled = True
+        self.breaker.record_success()
+
+    def failure(self):
+        self.settled = True
+        self.breaker.record_failure()
+
+
+def configure(config):
+    # Called again whenever the manifest changes; breakers keep their state unless their own settings changed, so an
+    # open circuit stays open
+    global policies
+    policies = dict(config or {})
+    with breakers_lock:
+        for endpoint, breaker in list(breakers.items()):
+            policy = get_policy(endpoint)
+            if (breaker.failure_threshold, breaker.recovery_time) != (policy['failure_threshold'],
+                                                                      policy['recovery_time']):
+                del breakers[endpoint]
+
+
+def get_policy(endpoint):
+    policy = dict(DEFAULT_POLICY)
+    policy.update(policies.get('default', {}))
+    policy.update(policies.get(endpoint, {}))
+    return policy
+
+
+def get_breaker(endpoint, policy):
+    with breakers_lock:
+        if endpoint not in breakers:
+            breakers[endpoint] = CircuitBreaker(policy['failure_threshold'], policy['recovery_time'])
+        return breakers[endpoint]
+
+
+def backoff_delay(policy, attempt):
+    # Full jitter: uniform in [0, min(backoff_max, backoff * 2^attempt)]
+    return random.uniform(0, min(policy['backoff_max'], policy['backoff'] * (2 ** attempt)))
+
+
+def request(endpoint, method, url, idempotent=True, session=None, account='', **kwargs):
+    # Sends a request under the endpoint's policy. Only idempotent calls are retried; connection errors, timeouts
+    # and 5xx responses count as failures. Raises requests.exceptions.RequestException subclasses on failure.
+    policy = get_policy(endpoint)
+    breaker = get_breaker(endpoint, policy)
+    attempts = (policy['retries'] + 1) if idempotent else 1
+    kwargs.setdefault('timeout', (policy['connect_timeout'], policy['read_timeout']))
+    start = time.monotonic()
+    outcome = 'error'
+    try:
+        for attempt in range(attempts):
+            if attempt:
+                Metrics.steam_request_retries.inc(endpoint=endpoint)
+            if not breaker.allow():
+                outcome = 'circuit_open'
+                raise CircuitOpenError('{0} is unavailable; not retrying for now'.format(endpoint))
+            with breaker.attempt() as result:
+                try:
+                    r = (session or requests).request(method, url, **kwargs)
+                    if r.status_code < 500:
+                        result.success()
+                        outcome = 'success' if r.status_code < 400 else 'http_' + str(r.status_code)
+                        return r
+                    result.failure()
+                    if attempt + 1 == attempts:
+                        outcome = 'http_' + str(r.status_code)
+                        r.raise_for_status()
+                except requests.exceptions.Timeout:
+                    result.failure()
+                    if attempt + 1 == attempts:
+                        outcome = 'timeout'
+                        raise
+                except requests.exceptions.ConnectionError:
+                    result.failure()
+                    if attempt + 1 == attempts:
+                        outcome = 'connection_error'
+                        raise
+            time.sleep(backoff_delay(policy, attempt))
+    finally:
+        Metrics.steam_requests.inc(endpoint=endpoint, account=account, outcome=outcome)
+        Metrics.steam_request_seconds.observe(time.monotonic() - start, endpoint=endpoint, account=account,
+                                              outcome=outcome)
@@ -0,0 +1,305 @@
+#    Copyright (c) 2019 melvyn2
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import threading
+import time
+import zlib
+
+from steam import guard
+
+import AccountStore
+import AsyncHandler
+import AuditLog
+import ChangeFeed
+import ConfirmationHandler
+import FileHandler
+import LoginHandler
+import Metrics
+import RequestHandler
+
+
+# Headless auto-confirmation for large fleets: a supervisor shards the manifest's accounts across worker processes
+# by a stable hash of their steamid and restarts workers that die. Workers ask the supervisor's coordinator, over an
+# authenticated localhost socket, for their current accounts, for the Steam time offset and for admission before
+# every Steam request, so the rate limit is global rather than per process. Settings come from the manifest, eg.
+# "sharding": {"workers": 4, "rate": 10, "burst": 10}; rate is Steam requests per second across all workers.
+
+
+def shard_of(steamid, shards):
+    return zlib.crc32(str(int(steamid)).encode('utf-8')) % shards
+
+
+def read_manifest(folder):
+    with FileHandler.locked(folder, False):
+        return FileHandler.read_json(os.path.join(folder, 'manifest.json'))
+
+
+class Coordinator(object):
+    def __init__(self, folder, shards, rate=10, burst=10, time_sync_interval=3600):
+        self.folder = folder
+        self.shards = shards
+        self.limiter = LoginHandler.RateLimiter(rate, burst)
+        self.time_sync_interval = time_sync_interval
+        self.time_offset = None
+        self.time_synced = 0
+        self.time_sync_failed = 0
+        self.time_syncing = False
+        self.lock = threading.Lock()
+        self.manifest_mtime = None
+        self.version = 0
+        self.assignment = {}
+        self.settings = {}
+        self.authkey = os.urandom(32)
+        self.listener = multiprocessing.connection.Listener(('127.0.0.1', 0), authkey=self.authkey)
+
+    def start(self):
+        self.reload()
+        threading.Thread(target=self.accept_loop, name='ShardCoordinator', daemon=True).start()
+
+    def reload(self):
+        # Rebalances when the manifest changes: every account's shard follows from its steamid alone, so adding or
+        # removing accounts only touches the shards those accounts hash to
+        try:
+            mtime = os.stat(os.path.join(self.folder, 'manifest.json')).st_mtime_ns
+            if mtime == self.manifest_mtime:
+                return False
+            manifest = read_manifest(self.folder)
+            assignment = {i: [] for i in range(self.shards)}
+            for entry in manifest['entries']:
+                assignment[shard_of(entry['steamid'], self.shards)].append(entry['filename'])
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+        with self.lock:
+            self.manifest_mtime = mtime
+            self.assignment = assignment
+            self.settings = {'trades': manifest.get('auto_confirm_trades', False),
+                             'markets': manifest.get('auto_confirm_market_transactions', False),
+                             'interval': max(1, manifest.get('periodic_checking_interval', 5)),
+                             'audit_log': manifest.get('audit_log'), 'change_feed': manifest.get('change_feed'),
+                             'pending_probe': manifest.get('pending_probe'), 'metrics': manifest.get('metrics'),
+                             'account_cache': manifest.get('account_cache')}
+            self.version += 1
+        return True
+
+    def get_time_offset(self):
+        # None until Steam has answered once; workers then sync on their own. A failed sync is retried a minute later
+        # rather than cached. The request is made outside the lock, so account requests never wait behind it, and
+        # callers that come in meanwhile get the last offset.
+        with self.lock:
+            due = self.time_offset is None or time.time() - self.time_synced > self.time_sync_interval
+            if not due or self.time_syncing or time.time() - self.time_sync_failed < 60:
+                return self.time_offset
+            self.time_syncing = True
+        offset = None
+        try:
+            offset = guard.get_time_offset()
+        finally:
+            with self.lock:
+                self.time_syncing = False
+                if offset is None:
+                    self.time_sync_failed = time.time()
+                else:
+                    self.time_offset = offset
+                    self.time_synced = time.time()
+        return offset if offset is not None else self.time_offset
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, multiprocessing.AuthenticationError):
+                continue
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'admit':
+                    self.limiter.wait()
+                    conn.send(True)
+                elif message[0] == 'time':
+                    conn.send(self.get_time_offset())
+                elif message[0] == 'accounts':
+                    with self.lock:
+                        conn.send((self.version, list(self.assignment.get(message[1], [])), dict(self.settings)))
+                else:
+                    conn.send(None)
+        except (EOFError, OSError):
+            conn.close()
+
+
+class ShardWorker(object):
+    def __init__(self, shard, address, authkey, folder):
+        self.shard = shard
+        self.folder = folder
+        self.conn = multiprocessing.connection.Client(address, authkey=authkey)
+        self.conn_lock = threading.Lock()
+        self.version = None
+        self.accounts = AccountStore.AccountStore(folder)
+        self.filenames = []
+
+    def call(self, *message):
+        with self.conn_lock:
+            self.conn.send(message)
+            return self.conn.recv()
+
+    async def ask(self, *message):
+        return await asyncio.get_event_loop().run_in_executor(None, self.call, *message)
+
+    def load(self, filenames, config):
+        # The manifest's account_cache bounds the live authenticators, whatever the size of the shard. Accounts that
+        # stay in this shard keep their refreshed sessions.
+        self.filenames = list(filenames)
+        self.accounts.configure(self.folder, config)
+        self.accounts.retain(filenames)
+
+    def read_account(self, filename):
+        with FileHandler.locked(self.folder, False):
+            maf = FileHandler.read_json(os.path.join(self.folder, filename))
+        return guard.SteamAuthenticator(maf)
+
+    def batch(self, filenames):
+        ret = []
+        for filename in filenames:
+            try:
+                ret.append(self.accounts.load(filename, lambda: self.read_account(filename)))
+            except (IOError, ValueError, KeyError):
+                continue
+        return ret
+
+    async def run(self):
+        async with AsyncHandler.AsyncClient() as client:
+            client.admission = lambda endpoint: self.ask('admit', endpoint)
+            while True:
+                version, filenames, settings = await self.ask('accounts', self.shard)
+                if version != self.version:
+                    self.load(filenames, settings['account_cache'])
+                    AuditLog.configure(self.folder, settings['audit_log'])
+                    ChangeFeed.configure(settings['change_feed'], self.shard)
+                    ConfirmationHandler.configure_probe(settings['pending_probe'])
+                    Metrics.configure(settings['metrics'], self.shard)
+                    self.version = version
+                if settings['trades'] or settings['markets']:
+                    client.time_offset = await self.ask('time')
+                    # Polled a cache-sized slice at a time, so no more authenticators are live than the cache holds.
+                    # The direction alternates, so the slice still cached from the last interval comes first.
+                    self.filenames.reverse()
+                    for start in range(0, len(self.filenames), self.accounts.capacity):
+                        await self.poll_slice(client, self.filenames[start:start + self.accounts.capacity], settings)
+                await asyncio.sleep(settings['interval'])
+
+    async def poll_slice(self, client, filenames, settings):
+        accounts = self.batch(filenames)
+        await client.sync_time(accounts)
+        await asyncio.gather(*(self.poll(client, sa, settings) for sa in accounts))
+
+    async def poll(self, client, sa, settings):
+        try:
+            if not await client.needs_fetch(sa):
+                return
+            if not await client.refresh_session(sa):
+                return
+            confs = await client.fetch_confirmations(sa)
+        except (AsyncHandler.aiohttp.ClientError, asyncio.TimeoutError, RequestHandler.CircuitOpenError):
+            return
+        confs = ConfirmationHandler.filter_confirmations(confs, settings['trades'], settings['markets'], False)
+        if len(confs):
+            await client.confirm_multi(sa, confs, 'allow')
+
+
+def worker_main(shard, address, authkey, folder):
+    # Ctrl-C is handled by the supervisor; a forked worker would otherwise inherit its SIGTERM handler
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    Metrics.reset()
+    try:
+        asyncio.run(ShardWorker(shard, address, authkey, folder).run())
+    except (EOFError, OSError):
+        # The supervisor went away
+        pass
+
+
+def supervise(folder, workers=None):
+    manifest = read_manifest(folder)
+    config = manifest.get('sharding') or {}
+    # The supervisor's own series cover the coordinator's time syncs; workers export theirs per shard
+    Metrics.configure(manifest.get('metrics'))
+    shards = workers or config.get('workers') or os.cpu_count()
+    coordinator = Coordinator(folder, shards, config.get('rate', 10), config.get('burst', 10))
+    coordinator.start()
+    processes = {}
+    started = {}
+    delays = {}
+    restart_at = {}
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda x, y: stopping.append(True))
+    print('Supervising', shards, 'worker(s) for', folder)
+    try:
+        while not stopping:
+            if coordinator.reload():
+                print('Manifest changed; rebalanced accounts')
+            for shard in range(shards):
+                proc = processes.get(shard)
+                if proc is not None and proc.is_alive():
+                    continue
+                if proc is not None:
+                    if shard not in restart_at:
+                        # Workers that die soon after starting are restarted with an exponential backoff
+                        if time.time() - started[shard] < 30:
+                            delays[shard] = min(60, delays.get(shard, 0.5) * 2)
+                        else:
+                            delays[shard] = 1
+                        restart_at[shard] = time.time() + delays[shard]
+                        print('Worker', shard, 'exited with code', proc.exitcode, '- restarting in', delays[shard],
+                              'seconds', file=sys.stderr)
+                    if time.time() < restart_at[shard]:
+                        continue
+                    del restart_at[shard]
+                proc = multiprocessing.Process(target=worker_main, name='ShardWorker-{0}'.format(shard),
+                                               args=(shard, coordinator.listener.address, coordinator.authkey, folder),
+                                               daemon=True)
+                proc.start()
+                processes[shard] = proc
+                started[shard] = time.time()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for proc in processes.values():
+        proc.terminate()
+    for proc in processes.values():
+        proc.join(5)
+
+
+def main(argv):
+    # PySteamAuth.py --supervise [--workers=N] [--mafiles=PATH]
+    options = dict(i[2:].split('=', 1) for i in argv if i.startswith('--') and '=' in i)
+    folder = options.get('mafiles')
+    if not folder:
+        base_path = os.path.dirname(os.path.abspath(sys.executable)) if getattr(sys, 'frozen', False) \
+            else os.path.dirname(os.path.abspath(__file__))
+        folder = os.path.join(base_path, 'maFiles')
+        if not os.path.isfile(os.path.join(folder, 'manifest.json')):
+            folder = os.path.expanduser(os.path.join('~', '.maFiles'))
+    if AsyncHandler.aiohttp is None:
+        raise SystemExit('--supervise requires aiohttp')
+    supervise(folder, int(options['workers']) if 'workers' in options else None)
@@ -23,7 +23,8 @@ FORMS += \
     ConfirmationDialog.ui \
     BackupCodesDeleteDialog.ui \
     AccountChooserDialog.ui \
-    BackupCodesCreatedDialog.ui
+    BackupCodesCreatedDialog.ui \
+    DashboardDialog.ui
 
 DISTFILES +=
 
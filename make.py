@@ -17,12 +17,18 @@
 
 
 import os
+import base64
+import concurrent.futures
 import errno
 import glob
+import hashlib
+import json
+import re
 import shutil
 import subprocess
 import sys
 import struct
+import tempfile
 import time
 
 
@@ -56,53 +62,338 @@ def delete(obj):
             raise err
 
 
-def build_qt_files():
+def source_hash(path):
+    # .qrc files are hashed together with the files they embed
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest.update(data)
+    if path.endswith('.qrc'):
+        for i in re.findall(r'<file[^>]*>(.*?)</file>', data.decode('utf-8')):
+            with open(os.path.join(os.path.dirname(path), i), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def find_rcc():
+    # pyrcc5 cannot write binary resources, so Qt's own rcc is needed for --qt-rcc
+    return os.environ.get('QT_RCC') or shutil.which('rcc') or shutil.which('rcc-qt5')
+
+
+def compile_qt_file(src, dst, in_process):
+    if dst.endswith('.rcc'):
+        subprocess.check_call([find_rcc(), '-binary', src, '-o', dst])
+    elif in_process:
+        if src.endswith('.ui'):
+            from PyQt5 import uic
+            from PyQt5.uic import exceptions
+            try:
+                with open(dst, 'w') as f:
+                    uic.compileUi(src, f)
+            except (exceptions.NoSuchClassError, exceptions.NoSuchWidgetError, exceptions.UnsupportedPropertyError,
+                    exceptions.WidgetPluginError, SyntaxError) as e:
+                raise RuntimeError('pyuic failed for {0}: {1}'.format(src, e))
+        else:
+            from PyQt5 import pyrcc_main
+            if not pyrcc_main.processResourceFile([src], dst, False):
+                raise RuntimeError('pyrcc failed for ' + src)
+    elif src.endswith('.ui'):
+        subprocess.check_call([sys.executable, '-m', 'PyQt5.uic.pyuic', src, '-o', dst])
+    else:
+        subprocess.check_call([sys.executable, '-m', 'PyQt5.pyrcc_main', src, '-o', dst])
+
+
+def lazy_init(modules):
+    # PyUIs.<name> still works as before, but each module is only imported the first time it is accessed
+    return """# Generated by make.py
+import importlib
+import sys
+import types
+
+__all__ = {0!r}
+
+
+class LazyPackage(types.ModuleType):
+    def __getattr__(self, name):
+        if name in __all__:
+            return importlib.import_module('.' + name, __name__)
+        raise AttributeError('module {{0!r}} has no attribute {{1!r}}'.format(__name__, name))
+
+
+sys.modules[__name__].__class__ = LazyPackage
+""".format(modules)
+
+
+def build_qt_files(force=False, in_process=False, binary_resources=False):
+    # Only .ui/.qrc files whose content hash changed since the last build are recompiled. Subprocess compiles run in
+    # parallel; in-process mode calls the PyQt5 compilers directly (serially) to skip interpreter start-up.
+    # With binary_resources, .qrc files become .rcc files that Common.load_resources registers on demand.
     psa_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PySteamAuth')
     pyuis_dir = os.path.join(psa_dir, 'PyUIs')
     uis_dir = os.path.join(psa_dir, 'UIs')
-    delete(pyuis_dir)
-    os.mkdir(pyuis_dir)
-    built_files = []
-    for f in glob.iglob(os.path.join(uis_dir, '*.ui')):
-        subprocess.call([sys.executable, '-m', 'PyQt5.uic.pyuic', f, '-o',
-                         os.path.join(pyuis_dir, os.path.basename(f).replace('.ui', '.py'))])
-        built_files.append(os.path.basename(f).replace('.ui', ''))
-    for f in glob.iglob(os.path.join(uis_dir, '*.qrc')):
-        subprocess.call([sys.executable, '-m', 'PyQt5.pyrcc_main', f, '-o',
-                         os.path.join(pyuis_dir, os.path.basename(f).replace('.qrc', '_rc.py'))])
-        built_files.append(os.path.basename(f).replace('.qrc', '_rc'))
-    with open(os.path.join(pyuis_dir, '__init__.py'), 'w') as f:
-        f.write('from . import ' + ', '.join(sorted(built_files)))
-    print('Built', len(built_files), 'PyUI files.')
+    hashes_path = os.path.join(pyuis_dir, '.hashes.json')
+    if binary_resources and not find_rcc():
+        print('Qt rcc not found (set QT_RCC to its path); compiling resources into Python modules instead')
+        binary_resources = False
+    if force:
+        delete(pyuis_dir)
+    os.makedirs(pyuis_dir, exist_ok=True)
+    try:
+        with open(hashes_path) as f:
+            old_hashes = json.load(f)
+    except (IOError, ValueError):
+        old_hashes = {}
+    try:
+        from PyQt5.QtCore import PYQT_VERSION_STR
+    except ImportError:
+        PYQT_VERSION_STR = ''
+
+    jobs = {}
+    hashes = {'PyQt5': PYQT_VERSION_STR}
+    outputs = []
+    for f in sorted(glob.glob(os.path.join(uis_dir, '*.ui')) + glob.glob(os.path.join(uis_dir, '*.qrc'))):
+        name = os.path.basename(f)
+        if name.endswith('.ui'):
+            output = name.replace('.ui', '.py')
+        elif binary_resources:
+            output = name.replace('.qrc', '.rcc')
+        else:
+            output = name.replace('.qrc', '_rc.py')
+        outputs.append(output)
+        dst = os.path.join(pyuis_dir, output)
+        hashes[name] = source_hash(f) + (':binary' if output.endswith('.rcc') else '')
+        if old_hashes.get('PyQt5') != hashes['PyQt5'] or old_hashes.get(name) != hashes[name] or \
+                not os.path.isfile(dst):
+            jobs[output] = (f, dst)
+    modules = sorted(i[:-3] for i in outputs if i.endswith('.py'))
+
+    for f in glob.glob(os.path.join(pyuis_dir, '*.py')) + glob.glob(os.path.join(pyuis_dir, '*.rcc')):
+        if os.path.basename(f) not in outputs + ['__init__.py']:
+            delete(f)
+    failed = []
+    if in_process:
+        for output, (src, dst) in jobs.items():
+            try:
+                compile_qt_file(src, dst, True)
+            except (subprocess.CalledProcessError, OSError, RuntimeError) as e:
+                print('Failed to compile', src + ':', e)
+                failed.append(output)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            futures = {pool.submit(compile_qt_file, src, dst, False): output for output, (src, dst) in jobs.items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except subprocess.CalledProcessError:
+                    failed.append(futures[future])
+    for output in failed:
+        hashes.pop(os.path.basename(jobs[output][0]), None)
+        delete(jobs[output][1])
+
+    init = lazy_init(modules)
+    init_path = os.path.join(pyuis_dir, '__init__.py')
+    try:
+        with open(init_path) as f:
+            write_init = f.read() != init
+    except IOError:
+        write_init = True
+    if write_init:
+        with open(init_path, 'w') as f:
+            f.write(init)
+    with open(hashes_path, 'w') as f:
+        json.dump(hashes, f, indent=1, sort_keys=True)
+    print('Built', len(jobs) - len(failed), 'of', len(outputs), 'PyUI files' +
+          (' (up to date).' if not jobs else '.'))
+    if failed:
+        raise SystemExit('Failed to build ' + ', '.join(sorted(failed)))
+
+
+def qt_build_args():
+    return {'force': '--rebuild-qt' in sys.argv, 'in_process': '--qt-in-process' in sys.argv,
+            'binary_resources': '--qt-rcc' in sys.argv}
+
+
+def nuitka_cache_key(args):
+    # Keyed on the sources that get compiled, the installed dependency versions (nuitka included) and the flags
+    digest = hashlib.sha256()
+    psa_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PySteamAuth')
+    for f in sorted(glob.glob(os.path.join(psa_dir, '*.py')) + glob.glob(os.path.join(psa_dir, 'PyUIs', '*.py'))):
+        digest.update(os.path.relpath(f, psa_dir).encode('utf-8'))
+        with open(f, 'rb') as fp:
+            digest.update(fp.read())
+    # Data files (eg. PyUIs/*.rcc) only appear as paths in the flags, so their contents are hashed as well
+    for i in sorted(args):
+        if i.startswith('--include-data-file='):
+            with open(i.split('=', 1)[1].rsplit('=', 1)[0], 'rb') as fp:
+                digest.update(fp.read())
+    try:
+        digest.update(subprocess.check_output([sys.executable, '-m', 'pip', 'freeze'], stderr=subprocess.DEVNULL))
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        print('Could not list installed packages; not using the build cache')
+        return None
+    digest.update(sys.version.encode('utf-8'))
+    digest.update(' '.join(args[3:]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def restore_nuitka_cache(key):
+    # Paths are relative to the build directory
+    try:
+        with open(os.path.join('cache', 'key')) as f:
+            if f.read() != key:
+                return False
+    except IOError:
+        return False
+    if not os.path.isdir(os.path.join('cache', 'PySteamAuth.dist')):
+        return False
+    delete('PySteamAuth.dist')
+    shutil.copytree(os.path.join('cache', 'PySteamAuth.dist'), 'PySteamAuth.dist', symlinks=True)
+    print('Sources, dependencies and Nuitka flags are unchanged; reusing the cached build')
+    return True
+
+
+def store_nuitka_cache(key):
+    delete('cache')
+    shutil.copytree('PySteamAuth.dist', os.path.join('cache', 'PySteamAuth.dist'), symlinks=True)
+    with open(os.path.join('cache', 'key'), 'w') as f:
+        f.write(key)
+
+
+def nuitka_env():
+    # Nuitka picks the C compiler cache up from these variables; object files are then reused across clean builds
+    env = dict(os.environ)
+    for var, binary in (('NUITKA_CCACHE_BINARY', 'ccache'), ('NUITKA_CLCACHE_BINARY', 'clcache')):
+        if var not in env and shutil.which(binary):
+            env[var] = shutil.which(binary)
+    return env
+
+
+def report_build_times(phase_times, version):
+    print('Build timing:')
+    for phase, seconds in phase_times:
+        print('    {0:<16} {1:8.1f}s'.format(phase, seconds))
+    print('    {0:<16} {1:8.1f}s'.format('Total', sum(i[1] for i in phase_times)))
+    # Appended to so build times can be compared across releases
+    with open(os.path.join('build', 'build_times.jsonl'), 'a') as f:
+        f.write(json.dumps({'time': int(time.time()), 'version': version, 'platform': sys.platform,
+                            'phases': dict(phase_times)}) + '\n')
+
+
+def dist_executable():
+    dist_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dist')
+    if sys.platform == 'darwin':
+        return os.path.join(dist_dir, 'PySteamAuth.app', 'Contents', 'MacOS', 'PySteamAuth')
+    elif sys.platform == 'win32':
+        return os.path.join(dist_dir, 'PySteamAuth.exe')
+    return os.path.join(dist_dir, 'PySteamAuth')
+
+
+def write_startup_fixture(folder, accounts=20):
+    # maFiles with made-up secrets, so that bench-startup times loading and validating them like a real start
+    entries = []
+    for i in range(accounts):
+        steamid = 76561197960265728 + i
+        filename = '{0}.maFile'.format(steamid)
+        with open(os.path.join(folder, filename), 'w') as f:
+            json.dump({'account_name': 'bench{0}'.format(i), 'steamid': steamid,
+                       'shared_secret': base64.b64encode(os.urandom(20)).decode('ascii'),
+                       'identity_secret': base64.b64encode(os.urandom(20)).decode('ascii'),
+                       'Session': {'SteamID': steamid}}, f)
+        entries.append({'steamid': steamid, 'encryption_iv': None, 'encryption_salt': None, 'filename': filename})
+    with open(os.path.join(folder, 'manifest.json'), 'w') as f:
+        json.dump({'periodic_checking': False, 'first_run': False, 'encrypted': False, 'periodic_checking_interval': 5,
+                   'periodic_checking_checkall': False, 'auto_confirm_market_transactions': False,
+                   'auto_confirm_trades': False, 'selected_account': 0, 'entries': entries}, f)
+
+
+def time_startup(cmd, mafiles):
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+    pre_time = time.perf_counter()
+    proc = subprocess.Popen(cmd + ['--bench-startup', '--mafiles=' + mafiles], stdout=subprocess.PIPE, env=env)
+    try:
+        for line in proc.stdout:
+            if line.startswith(b'BENCH-STARTUP'):
+                elapsed = time.perf_counter() - pre_time
+                rss_kb = int(line.split()[1])
+                break
+        else:
+            raise SystemExit('Startup benchmark got no report from ' + cmd[-1])
+        proc.wait(timeout=30)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+    return elapsed, rss_kb
+
+
+def bench_startup(cmd, runs, clear_bytecode):
+    # The first run is cold: for the source build all bytecode caches are removed first, so it includes compiling
+    # every module. Page caches are not dropped, so the compiled build's cold run is only as cold as the OS allows.
+    if clear_bytecode:
+        for root, dirnames, filenames in os.walk(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                              'PySteamAuth')):
+            if '__pycache__' in dirnames:
+                delete(os.path.join(root, '__pycache__'))
+    mafiles = tempfile.mkdtemp(prefix='psa-bench-')
+    try:
+        write_startup_fixture(mafiles)
+        cold, cold_rss = time_startup(cmd, mafiles)
+        warm = [time_startup(cmd, mafiles) for _ in range(runs)]
+    finally:
+        delete(mafiles)
+    return {'cold_seconds': round(cold, 3),
+            'warm_seconds': round(sorted(i[0] for i in warm)[len(warm) // 2], 3),
+            'peak_rss_kb': max([cold_rss] + [i[1] for i in warm])}
+
+
+def get_option(name, default):
+    for i in sys.argv:
+        if i.startswith(name + '='):
+            return type(default)(i.split('=', 1)[1])
+    return default
 
 
 action = sys.argv[1].lower() if len(sys.argv) >= 2 else None
 
 if action == 'build':
+    phase_times = []
+    pre_time = time.time()
     if '--dont-clean' not in sys.argv:
         clean()
+    phase_times.append(('Clean', time.time() - pre_time))
+    pre_time = time.time()
     if '--dont-build-qt' not in sys.argv:
-        build_qt_files()
+        build_qt_files(**qt_build_args())
+    phase_times.append(('Qt build', time.time() - pre_time))
     os.chdir('build')
-    try:
-        pre_time = time.time()
-        args = [sys.executable, '-m', 'nuitka', '--standalone', '--follow-imports',
-                os.path.join('..', 'PySteamAuth', 'PySteamAuth.py')]
-        if sys.platform == 'linux':
-            args.append('--plugin-enable=qt-plugins=sensible,platformthemes')
-        else:
-            args.append('--plugin-enable=qt-plugins=sensible,styles')
-        if sys.platform == 'win32':
-            args.append('--windows-disable-console')
-            args.append('--assume-yes-for-downloads')
-            args.append('--plugin-enable=gevent')
+    pre_time = time.time()
+    # PyUIs imports its modules lazily, so Nuitka cannot follow them on its own
+    args = [sys.executable, '-m', 'nuitka', '--standalone', '--follow-imports', '--include-package=PyUIs',
+            os.path.join('..', 'PySteamAuth', 'PySteamAuth.py')]
+    for f in glob.glob(os.path.join('..', 'PySteamAuth', 'PyUIs', '*.rcc')):
+        args.append('--include-data-file={0}=PyUIs/{1}'.format(f, os.path.basename(f)))
+    if sys.platform == 'linux':
+        args.append('--plugin-enable=qt-plugins=sensible,platformthemes')
+    else:
+        args.append('--plugin-enable=qt-plugins=sensible,styles')
+    if sys.platform == 'win32':
+        args.append('--windows-disable-console')
+        args.append('--assume-yes-for-downloads')
+        args.append('--plugin-enable=gevent')
+    cache_key = None if '--no-cache' in sys.argv else nuitka_cache_key(args)
+    if cache_key is not None and restore_nuitka_cache(cache_key):
+        phase_times.append(('Nuitka (cached)', time.time() - pre_time))
+    else:
         if '-v' in sys.argv:
             args.append('--show-progress')
-        sp = subprocess.check_output(args, shell=(True if sys.platform == 'win32' else False))
-        print('Nuitka compilation took', time.time() - pre_time, 'seconds')
-    except subprocess.CalledProcessError:
-        print('Nuitka compilation failed')
-        sys.exit(1)
+        try:
+            sp = subprocess.check_output(args, env=nuitka_env(), shell=(True if sys.platform == 'win32' else False))
+        except subprocess.CalledProcessError:
+            print('Nuitka compilation failed')
+            sys.exit(1)
+        phase_times.append(('Nuitka', time.time() - pre_time))
+        if cache_key is not None:
+            store_nuitka_cache(cache_key)
+    pre_time = time.time()
 
     try:
         version = subprocess.check_output(['git', 'describe', '--exact-match'], stderr=subprocess.PIPE) \
@@ -177,6 +468,8 @@ if action == 'build':
         import platform
         archive_name = 'PySteamAuth-' + version + '-' + sys.platform + '-' + platform.machine()
         shutil.make_archive(os.path.join('pkg', archive_name), format='zip', root_dir='dist')
+    phase_times.append(('Packaging', time.time() - pre_time))
+    report_build_times(phase_times, version)
 
 elif action == 'install':
     try:
@@ -253,7 +546,7 @@ elif action == 'install':
 
 elif action == 'run':
     if '--dont-rebuild-ui' not in sys.argv:
-        build_qt_files()
+        build_qt_files(**qt_build_args())
     argv = list(filter('--dont-rebuild-ui'.__ne__, sys.argv[2:]))
     os.execl(sys.executable, sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PySteamAuth',
                                                           'PySteamAuth.py'), *argv)
@@ -265,7 +558,7 @@ elif action == 'deps':
     subprocess.call([sys.executable, '-m', 'pip', 'install', '-U', '-r', 'requirements.txt'])
 
 elif action == 'pyqt-build':
-    build_qt_files()
+    build_qt_files(**qt_build_args())
 
 elif action == 'test':
     if sys.platform != 'win32':
@@ -313,6 +606,42 @@ elif action == 'test':
         pass
     sys.exit(final_code)
 
+elif action == 'bench-startup':
+    runs = get_option('--runs', 5)
+    if runs < 1:
+        raise SystemExit('ERROR: --runs must be at least 1')
+    margin = get_option('--margin', 0.2)
+    baseline_path = get_option('--baseline', os.path.join('build', 'startup_baseline.json'))
+    results = {'source': bench_startup([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                     'PySteamAuth', 'PySteamAuth.py')], runs, True)}
+    if os.path.isfile(dist_executable()):
+        results['dist'] = bench_startup([dist_executable()], runs, False)
+    else:
+        print('No compiled build in dist; only benchmarking the source run')
+
+    try:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    except IOError:
+        baseline = None
+    regressions = []
+    for target, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            limit = baseline.get(target, {}).get(metric) if baseline and '--update-baseline' not in sys.argv else None
+            if limit is not None and value > limit * (1 + margin) and value > 0:
+                regressions.append((target, metric))
+            print('{0:<7} {1:<13} {2:>10}'.format(target, metric, value) + ('' if not limit else
+                  '  (baseline {0}, {1:+.0%})'.format(limit, value / limit - 1)))
+
+    if baseline is None or '--update-baseline' in sys.argv:
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+        print('Wrote baseline to', baseline_path)
+    elif regressions:
+        print('Exceeded the baseline by more than {0:.0%}:'.format(margin),
+              ', '.join(target + ' ' + metric for target, metric in regressions))
+        sys.exit(1)
+
 elif action == 'deploy':
     if not glob.glob(os.path.join('pkg', '*.zip')):
         print('Nothing to upload')
@@ -405,5 +734,7 @@ elif action == 'deploy':
 
 else:
     print('Invalid usage')
-    print('Possible options: build [--zip] [-v] [--dont-rebuild-ui], install, run [--dont-rebuild-ui],'
-          ' clean, deps, pyqt-build')
+    print('Possible options: build [--zip] [-v] [--no-cache] [--dont-rebuild-ui], install, run [--dont-rebuild-ui],'
+          ' clean, deps, pyqt-build, bench-startup [--runs=N] [--margin=0.2] [--baseline=path] [--update-baseline]')
+    print('Qt build options: --rebuild-qt (ignore the hash cache), --qt-in-process (no pyuic/pyrcc subprocesses),'
+          ' --qt-rcc (binary resources loaded on demand)')